@@ -1,5 +1,59 @@
 import numpy as np
 from console_progressbar import ProgressBar
+import profiling
+import dataset
+
+# Причины остановки оптимизаторов
+STOP_MAX_ITER = "max_iter"          # выполнено заданное количество итераций
+STOP_SMALL_STEP = "small_step"      # изменение каждого параметра не больше epsilon
+STOP_NO_CHANGE = "no_change"        # функция потерь не уменьшалась max_n_iter_no_change итераций
+STOP_NO_DESCENT = "no_descent"      # не найден шаг, уменьшающий функцию потерь
+STOP_NON_FINITE = "non_finite"      # переполнение не удалось устранить уменьшением шага
+
+
+class OptimizationResult:
+    """
+    Результат оптимизации
+    """
+
+    def __init__(self, method, parameters, loss, n_iter, stop_reason, n_loss, n_gradient, iterations=None, loss_history=None, trace=None, info=None):
+        """
+        :param method: название оптимизатора
+        :param parameters: найденные параметры
+        :param loss: функция потерь в найденных параметрах
+        :param n_iter: количество выполненных итераций
+        :param stop_reason: причина остановки (STOP_MAX_ITER, STOP_SMALL_STEP, STOP_NO_CHANGE, STOP_NO_DESCENT, STOP_NON_FINITE)
+        :param n_loss: количество вычислений функции потерь (включая вычисления для градиента по центральной разности)
+        :param n_gradient: количество вычислений градиента (для метода Левенберга-Марквардта - невязок и матрицы Якоби)
+        :param iterations: номера итераций, после которых сохранена функция потерь (0 - начальные параметры)
+        :param loss_history: значения функции потерь на этих итерациях
+        :param trace: трассировка (см. profiling.Trace) или None
+        :param info: словарь с дополнительными сведениями, зависящими от оптимизатора
+        """
+        self.method = method
+        self.parameters = parameters
+        self.loss = float(loss)
+        self.n_iter = n_iter
+        self.stop_reason = stop_reason
+        self.n_loss = n_loss
+        self.n_gradient = n_gradient
+        self.iterations = iterations
+        self.loss_history = loss_history
+        self.trace = trace
+        self.info = {} if info is None else info
+
+    def as_dict(self):
+        """
+        :return: словарь с полями результата, пригодный для сохранения в JSON
+        """
+        return {"method": self.method, "parameters": np.asarray(self.parameters).tolist(), "loss": self.loss,
+                "n_iter": self.n_iter, "stop_reason": self.stop_reason, "n_loss": self.n_loss, "n_gradient": self.n_gradient,
+                "iterations": self.iterations, "loss_history": self.loss_history,
+                "trace": None if self.trace is None else self.trace.as_dict()}
+
+    def __repr__(self):
+        return (f"{self.method}: loss = {self.loss:.6g}, n_iter = {self.n_iter}, stop_reason = {self.stop_reason}, "
+                f"n_loss = {self.n_loss}, n_gradient = {self.n_gradient}, parameters = {self.parameters}")
 
 def gradient(function, parameters, argument_increment=1e-06):
     """
@@ -24,14 +78,17 @@ def gradient(function, parameters, argument_increment=1e-06):
 
 def gradient_lf(loss_function, parameters, X, Y, argument_increment=1e-06):
     """
-        Алгоритм для вычисления градиента по формуле центральной разности для функций потерь
+        Алгоритм для вычисления градиента по формуле центральной разности для функций потерь. Если у функции потерь
+        есть атрибут batch (пакетная функция потерь), все точки шаблона оцениваются одним вызовом (см. gradient_lf_batch)
         :param loss_function: исходная функция потерь
         :param parameters: параметры функции
-        :param X: матрица входных данных
-        :param Y: матрица выходных данных
+        :param X: матрица входных данных или dataset.Dataset
+        :param Y: матрица выходных данных (None, если X - Dataset)
         :param argument_increment: значение приращения аргумента (не обязательно)
         :return:
         """
+    batch_loss_function = getattr(loss_function, "batch", None)
+    if batch_loss_function is not None: return gradient_lf_batch(batch_loss_function, parameters, X, Y, argument_increment)
     gradient = []
     for _ in range(len(parameters)):
         gradient.append(0)
@@ -42,9 +99,30 @@ def gradient_lf(loss_function, parameters, X, Y, argument_increment=1e-06):
         parameters_h_minus[i] -= argument_increment
         fun_plus = loss_function(*parameters_h_plus, X, Y)
         fun_minus = loss_function(*parameters_h_minus, X, Y)
-        gradient[i] = float((fun_plus - fun_minus) / (2 * argument_increment))
+        # При бесконечной функции потерь производная равна nan, такие шаги отбрасываются оптимизаторами
+        with np.errstate(invalid="ignore"):
+            gradient[i] = float((fun_plus - fun_minus) / (2 * argument_increment))
     return np.array(gradient)
 
+def gradient_lf_batch(batch_loss_function, parameters, X, Y, argument_increment=1e-06):
+    """
+        Алгоритм для вычисления градиента по формуле центральной разности, все 2*n точек шаблона
+        оцениваются одним вызовом пакетной функции потерь
+        :param batch_loss_function: функция потерь, принимающая матрицу параметров (P, n) и возвращающая P значений
+        :param parameters: параметры функции
+        :param X: матрица входных данных или dataset.Dataset
+        :param Y: матрица выходных данных (None, если X - Dataset)
+        :param argument_increment: значение приращения аргумента (не обязательно)
+        :return:
+        """
+    parameters = np.asarray(parameters, dtype=float)
+    shift = argument_increment * np.eye(len(parameters))
+    stencil = np.concatenate((parameters + shift, parameters - shift))
+    loss = batch_loss_function(stencil, X, Y)
+    # При бесконечной функции потерь производная равна nan, такие шаги отбрасываются оптимизаторами
+    with np.errstate(invalid="ignore"):
+        return (loss[:len(parameters)] - loss[len(parameters):]) / (2 * argument_increment)
+
 
 def gradient_descent(function, initial_parameters, alpha, n_iter, epsilon=1e-06):
     """
@@ -65,31 +143,121 @@ def gradient_descent(function, initial_parameters, alpha, n_iter, epsilon=1e-06)
         parameters -= difference
     return parameters
 
-def gradient_descent_lf(loss_function, initial_parameters, alpha, n_iter, X, Y, epsilon=1e-06):
+def _start_trace(trace, name, loss_function, gradient_function):
+    """
+    Создание трассировки оптимизатора (см. profiling.py) и обертка функций для подсчета их вызовов
+    :param trace: вести ли трассировку
+    :param name: название оптимизатора
+    :param loss_function: функция потерь
+    :param gradient_function: функция градиента или None
+    :return: трассировка (None, если trace=False), функция потерь и функция градиента
+    """
+    if not trace: return None, loss_function, gradient_function
+    tr = profiling.Trace(name)
+    batch_loss_function = getattr(loss_function, "batch", None)
+    loss_function = profiling.counted(loss_function, tr, "loss_function")
+    if batch_loss_function is not None: loss_function.batch = profiling.counted(batch_loss_function, tr, "batch_loss_function")
+    if gradient_function is not None: gradient_function = profiling.counted(gradient_function, tr, "gradient")
+    return tr, loss_function, gradient_function
+
+def _finish(return_result, tr, result):
+    """
+    Возвращаемое оптимизатором значение
+    :param return_result: возвращать OptimizationResult
+    :param tr: трассировка или None
+    :param result: результат оптимизации
+    :return: результат, либо параметры (и трассировка, если она велась)
+    """
+    if tr is not None: tr.n_iter = result.n_iter
+    if return_result: return result
+    return result.parameters if tr is None else (result.parameters, tr)
+
+def gradient_descent_lf(loss_function, initial_parameters, alpha, n_iter, X, Y, epsilon=1e-06, gradient_function=None, trace=False, suppress_stdout=False, history=False, return_result=False, max_backtracks=10):
     """
     Алгоритм градиентного спуска для поиска локального минимума функции потерь
     :param loss_function: функция потерь, минимум которой необходимо найти
     :param initial_parameters: начальные значения параметров
     :param alpha: скорость спуска
     :param n_iter: количество итераций
-    :param X: матрица входных данных
-    :param Y: матрица выходных данных
+    :param X: матрица входных данных или dataset.Dataset
+    :param Y: матрица выходных данных (None, если X - Dataset)
     :param epsilon: значение для остановки алгоритма, когда изменение по каждому параметру <= epsilon (не обязательно)
-    :return: значение параметров в предполагаемом минимуме функции
+    :param gradient_function: функция градиента с той же сигнатурой, что и функция потерь (не обязательно). По умолчанию используется атрибут gradient функции потерь, а если его нет - формула центральной разности
+    :param trace: вести трассировку (см. profiling.Trace): количество вызовов, время этапов и функцию потерь по итерациям.
+    Сам спуск функцию потерь не использует, поэтому она считается на каждой итерации только при трассировке или history=True
+    :param suppress_stdout: не выводить сообщения и индикатор прогресса
+    :param history: сохранять функцию потерь на каждой итерации
+    :param return_result: вернуть OptimizationResult вместо параметров
+    :param max_backtracks: сколько раз подряд можно уменьшать шаг вдвое, если градиент в новой точке не конечен (переполнение)
+    :return: значение параметров в предполагаемом минимуме функции (и трассировка, если trace=True) или OptimizationResult
     """
     parameters = initial_parameters.copy()
-    print("Расчет оптимальных параметров методом градиентного спуска")
-    pb = ProgressBar(total=n_iter-1, prefix='Progress', suffix='Complete', length=50)
-    for i in range(n_iter):
-        G = gradient_lf(loss_function, parameters, X, Y)
-        difference = alpha * G
-        if np.all(np.abs(difference) <= epsilon):
-            pb.print_progress_bar(n_iter-1)
-            print(f"Досрочный выход. n_iter = {i}")
-            break
-        parameters -= difference
-        pb.print_progress_bar(i)
-    return parameters
+    if gradient_function is None: gradient_function = getattr(loss_function, "gradient", None)
+    finite_difference = gradient_function is None
+    tr, loss_function, gradient_function = _start_trace(trace, "gradient_descent_lf", loss_function, gradient_function)
+    iterations, loss_history = ([], []) if history else (None, None)
+    n_loss = 0
+    n_done = 0
+    stop_reason = STOP_MAX_ITER
+    # Текущая скорость спуска, количество отброшенных шагов (всего и подряд) и последняя точка с конечным градиентом
+    step_alpha = alpha
+    n_rejected = 0
+    n_backtracks = 0
+    previous = None
+    with profiling.tracing(tr):
+        if not suppress_stdout:
+            print("Расчет оптимальных параметров методом градиентного спуска")
+            pb = ProgressBar(total=n_iter-1, prefix='Progress', suffix='Complete', length=50)
+        for i in range(n_iter):
+            n_done = i + 1
+            with profiling.phase(tr, "gradient"):
+                G = gradient_lf(loss_function, parameters, X, Y) if finite_difference else gradient_function(*parameters, X, Y)
+            if not np.all(np.isfinite(G)):
+                # Шаг привел в область переполнения: повтор шага из предыдущей точки с вдвое меньшей скоростью спуска
+                if previous is None or n_backtracks >= max_backtracks:
+                    if previous is not None: parameters = previous[0]
+                    stop_reason = STOP_NON_FINITE
+                    if not suppress_stdout:
+                        with profiling.phase(tr, "progress"):
+                            pb.print_progress_bar(n_iter-1)
+                            print(f"Досрочный выход из-за переполнения. n_iter = {i}")
+                    break
+                n_rejected += 1
+                n_backtracks += 1
+                step_alpha /= 2
+                parameters = previous[0] - step_alpha * previous[1]
+                continue
+            n_backtracks = 0
+            difference = step_alpha * G
+            if np.all(np.abs(difference) <= epsilon):
+                stop_reason = STOP_SMALL_STEP
+                if not suppress_stdout:
+                    with profiling.phase(tr, "progress"):
+                        pb.print_progress_bar(n_iter-1)
+                        print(f"Досрочный выход. n_iter = {i}")
+                break
+            previous = (parameters.copy(), G)
+            parameters -= difference
+            if history or tr is not None:
+                with profiling.phase(tr, "loss"):
+                    loss = loss_function(*parameters, X, Y)
+                n_loss += 1
+                if history:
+                    iterations.append(i + 1)
+                    loss_history.append(float(loss))
+                if tr is not None: tr.record_loss(i + 1, loss)
+            if not suppress_stdout:
+                with profiling.phase(tr, "progress"):
+                    pb.print_progress_bar(i)
+        if return_result:
+            with profiling.phase(tr, "loss"):
+                loss = loss_function(*parameters, X, Y)
+            n_loss += 1
+    n_gradient = n_done
+    if finite_difference: n_loss += 2 * len(parameters) * n_gradient
+    result = OptimizationResult("gradient_descent_lf", parameters, loss if return_result else np.nan, n_done, stop_reason, n_loss, n_gradient, iterations, loss_history, tr,
+                                info={"alpha": step_alpha, "n_rejected": n_rejected})
+    return _finish(return_result, tr, result)
 
 
 # def stochastic_gradient_descent_lf(loss_function, initial_parameters, alpha, n_iter, X, Y, epsilon=1e-06, seed = 0):
@@ -127,98 +295,376 @@ def gradient_descent_lf(loss_function, initial_parameters, alpha, n_iter, X, Y,
 #         pb.print_progress_bar(i)
 #     return best_parameters
 
-def stochastic_gradient_descent_lf(loss_function, initial_parameters, alpha, n_iter, X, Y, epsilon=1e-06, max_n_iter_no_change = 10, seed = 0):
+def stochastic_gradient_descent_lf(loss_function, initial_parameters, alpha, n_iter, X, Y, epsilon=1e-06, max_n_iter_no_change = 10, seed = 0, gradient_function=None, trace=False, suppress_stdout=False, history=False, return_result=False, max_backtracks=10):
     """
     Алгоритм градиентного спуска для поиска локального минимума функции потерь
     :param loss_function: функция потерь, минимум которой необходимо найти
     :param initial_parameters: начальные значения параметров
     :param alpha: скорость спуска
     :param n_iter: количество итераций
-    :param X: матрица входных данных
-    :param Y: матрица выходных данных
+    :param X: матрица входных данных или dataset.Dataset
+    :param Y: матрица выходных данных (None, если X - Dataset)
     :param epsilon: значение для остановки алгоритма, когда изменение по каждому параметру <= epsilon (не обязательно)
     :param max_n_iter_no_change: максимальное количество итерации подряд, в течении которых функция потерь не уменьшается на значение больше или равное epsilon
     :param seed: значения для инициализации генератора случайных чисел (0)
-    :return: значение параметров в предполагаемом минимуме функции
+    :param gradient_function: функция градиента с той же сигнатурой, что и функция потерь (не обязательно). По умолчанию используется атрибут gradient функции потерь, а если его нет - формула центральной разности
+    :param trace: вести трассировку (см. profiling.Trace): количество вызовов, время этапов и функцию потерь по итерациям
+    :param suppress_stdout: не выводить сообщения и индикатор прогресса
+    :param history: сохранять функцию потерь на каждой итерации
+    :param return_result: вернуть OptimizationResult вместо параметров
+    :param max_backtracks: сколько раз подряд можно возвращаться в последнюю точку с конечной функцией потерь, уменьшая скорость спуска вдвое (переполнение)
+    :return: значение параметров в предполагаемом минимуме функции (и трассировка, если trace=True) или OptimizationResult
     """
     parameters = initial_parameters.copy()
-    best_loss = loss_function(*parameters, X, Y)
-    best_parameters = parameters.copy()
-    rng = np.random.default_rng(seed)
-    print("Расчет оптимальных параметров методом стохастического градиентного спуска")
-    pb = ProgressBar(total=n_iter-1, prefix='Progress', suffix='Complete', length=50)
-    n_iter_no_change = 0
-    for i in range(n_iter):
-        random_index = rng.integers(0, len(X))
-        G = gradient_lf(loss_function, parameters, X[random_index], Y[random_index])
-        difference = alpha * G
-        parameters -= difference
-        loss = loss_function(*parameters, X, Y)
-        if loss + epsilon > best_loss:n_iter_no_change += 1
-        else: n_iter_no_change = 0
-        if n_iter_no_change >= max_n_iter_no_change:
-            pb.print_progress_bar(n_iter - 1)
-            print(f"Досрочный выход. n_iter = {i}")
-            break
-        if loss < best_loss:
-            best_loss = loss
-            best_parameters = parameters.copy()
-        pb.print_progress_bar(i)
-    return best_parameters
+    if gradient_function is None: gradient_function = getattr(loss_function, "gradient", None)
+    finite_difference = gradient_function is None
+    tr, loss_function, gradient_function = _start_trace(trace, "stochastic_gradient_descent_lf", loss_function, gradient_function)
+    iterations, loss_history = ([0], []) if history else (None, None)
+    n_done = 0
+    stop_reason = STOP_MAX_ITER
+    step_alpha = alpha
+    n_rejected = 0
+    n_backtracks = 0
+    with profiling.tracing(tr):
+        with profiling.phase(tr, "loss"):
+            best_loss = loss_function(*parameters, X, Y)
+        if history: loss_history.append(float(best_loss))
+        best_parameters = parameters.copy()
+        rng = np.random.default_rng(seed)
+        if not suppress_stdout:
+            print("Расчет оптимальных параметров методом стохастического градиентного спуска")
+            pb = ProgressBar(total=n_iter-1, prefix='Progress', suffix='Complete', length=50)
+        n_iter_no_change = 0
+        for i in range(n_iter):
+            n_done = i + 1
+            with profiling.phase(tr, "sampling"):
+                random_index = rng.integers(0, len(X))
+                sample_X, sample_Y = dataset.take(X, Y, random_index)
+            with profiling.phase(tr, "gradient"):
+                G = gradient_lf(loss_function, parameters, sample_X, sample_Y) if finite_difference else gradient_function(*parameters, sample_X, sample_Y)
+            difference = step_alpha * G
+            previous_parameters = parameters.copy()
+            parameters -= difference
+            with profiling.phase(tr, "loss"):
+                loss = loss_function(*parameters, X, Y)
+            if not np.isfinite(loss):
+                # Шаг привел в область переполнения: возврат в предыдущую точку, скорость спуска уменьшается вдвое
+                parameters = previous_parameters
+                n_rejected += 1
+                n_backtracks += 1
+                if n_backtracks > max_backtracks:
+                    stop_reason = STOP_NON_FINITE
+                    if not suppress_stdout:
+                        with profiling.phase(tr, "progress"):
+                            pb.print_progress_bar(n_iter - 1)
+                            print(f"Досрочный выход из-за переполнения. n_iter = {i}")
+                    break
+                step_alpha /= 2
+                continue
+            n_backtracks = 0
+            if history:
+                iterations.append(i + 1)
+                loss_history.append(float(loss))
+            if tr is not None: tr.record_loss(i + 1, loss)
+            if loss + epsilon > best_loss:n_iter_no_change += 1
+            else: n_iter_no_change = 0
+            if n_iter_no_change >= max_n_iter_no_change:
+                stop_reason = STOP_NO_CHANGE
+                if not suppress_stdout:
+                    with profiling.phase(tr, "progress"):
+                        pb.print_progress_bar(n_iter - 1)
+                        print(f"Досрочный выход. n_iter = {i}")
+                break
+            if loss < best_loss:
+                best_loss = loss
+                best_parameters = parameters.copy()
+            if not suppress_stdout:
+                with profiling.phase(tr, "progress"):
+                    pb.print_progress_bar(i)
+    n_loss = n_done + 1 + (2 * len(parameters) * n_done if finite_difference else 0)
+    result = OptimizationResult("stochastic_gradient_descent_lf", best_parameters, best_loss, n_done, stop_reason, n_loss, n_done, iterations, loss_history, tr,
+                                info={"alpha": step_alpha, "n_rejected": n_rejected})
+    return _finish(return_result, tr, result)
 
-def minibatch_stochastic_gradient_descent_lf(loss_function, initial_parameters, alpha, n_iter, X, Y, batch_size, epsilon=1e-06, max_n_iter_no_change = 10, seed = 0, suppress_stdout = False):
+def minibatch_stochastic_gradient_descent_lf(loss_function, initial_parameters, alpha, n_iter, X, Y, batch_size, epsilon=1e-06, max_n_iter_no_change = 10, seed = 0, suppress_stdout = False, gradient_function=None, loss_check_every=1, loss_check_size=None, trace=False, history=False, return_result=False, max_backtracks=10):
     """
     Алгоритм градиентного спуска для поиска локального минимума функции потерь
     :param loss_function: функция потерь, минимум которой необходимо найти
     :param initial_parameters: начальные значения параметров
     :param alpha: скорость спуска
     :param n_iter: количество итераций
-    :param X: матрица входных данных
-    :param Y: матрица выходных данных
+    :param X: матрица входных данных (список или массив, в том числе отображенный в память, см. data_loader.py) или dataset.Dataset
+    :param Y: матрица выходных данных (None, если X - Dataset)
     :param batch_size: размер одного пакета
     :param epsilon: значение для остановки алгоритма, когда изменение по каждому параметру <= epsilon (не обязательно)
     :param max_n_iter_no_change: максимальное количество итерации подряд, в течении которых функция потерь не уменьшается на значение больше или равное epsilon
     :param seed: значения для инициализации генератора случайных чисел (0)
-    :return: значение параметров в предполагаемом минимуме функции
+    :param suppress_stdout: не выводить сообщения и индикатор прогресса
+    :param gradient_function: функция градиента с той же сигнатурой, что и функция потерь (не обязательно). По умолчанию используется атрибут gradient функции потерь, а если его нет - формула центральной разности
+    :param loss_check_every: через сколько итераций проверять функцию потерь для досрочной остановки и выбора лучших параметров
+    :param loss_check_size: размер отложенной подвыборки, на которой проверяется функция потерь (не участвует в обучении). 0 < loss_check_size < len(X), None - проверка по всем данным
+    :param trace: вести трассировку (см. profiling.Trace): количество вызовов, время этапов и функцию потерь на итерациях проверки
+    :param history: сохранять функцию потерь на итерациях проверки
+    :param return_result: вернуть OptimizationResult вместо параметров (функция потерь в результате посчитана на данных проверки)
+    :param max_backtracks: сколько раз подряд можно возвращаться в последнюю проверенную точку с конечной функцией потерь, уменьшая скорость спуска вдвое (переполнение)
+    :return: значение параметров в предполагаемом минимуме функции (и трассировка, если trace=True) или OptimizationResult
     """
-    X = np.array(X)
-    Y = np.array(Y)
+    if gradient_function is None: gradient_function = getattr(loss_function, "gradient", None)
+    finite_difference = gradient_function is None
+    tr, loss_function, gradient_function = _start_trace(trace, "minibatch_stochastic_gradient_descent_lf", loss_function, gradient_function)
+    # Массивы (в том числе отображенные в память, см. data_loader.py) и Dataset не копируются
+    X, Y = dataset.as_arrays(X, Y)
+    if loss_check_size is not None and not 0 < loss_check_size < len(X):
+        raise ValueError(f"Размер подвыборки для проверки loss_check_size={loss_check_size} должен быть больше 0 и меньше количества образцов {len(X)}")
     parameters = initial_parameters.copy()
-    best_loss = loss_function(*parameters, X, Y)
-    best_parameters = parameters.copy()
     rng = np.random.default_rng(seed)
-    indices = rng.choice(X.shape[0], size=len(X), replace=False)
-    shuffled_X = X[indices]
-    shuffled_Y = Y[indices]
-    start = 0
+    # Пакеты выбираются по перемешиваемому вектору индексов, сами данные не переставляются и не копируются целиком
+    indices = rng.permutation(len(X))
+    if loss_check_size is None:
+        check_X, check_Y = X, Y
+    else:
+        check_indices = np.sort(indices[:loss_check_size])
+        check_X, check_Y = dataset.take(X, Y, check_indices)
+        indices = indices[loss_check_size:]
+    iterations, loss_history = ([0], []) if history else (None, None)
+    n_loss = 1
+    n_done = 0
+    stop_reason = STOP_MAX_ITER
+    step_alpha = alpha
+    n_rejected = 0
+    n_backtracks = 0
+    with profiling.tracing(tr):
+        with profiling.phase(tr, "loss"):
+            best_loss = loss_function(*parameters, check_X, check_Y)
+        if history: loss_history.append(float(best_loss))
+        best_parameters = parameters.copy()
+        # Последняя проверенная точка с конечной функцией потерь, в нее спуск возвращается при переполнении
+        good_parameters = parameters.copy()
+        start = 0
+        if not suppress_stdout:
+            print("Расчет оптимальных параметров методом мини-пакетного стохастического градиентного спуска")
+            pb = ProgressBar(total=n_iter-1, prefix='Progress', suffix='Complete', length=50)
+        n_iter_no_change = 0
+        for i in range(n_iter):
+            n_done = i + 1
+            with profiling.phase(tr, "sampling"):
+                if start >= len(indices):
+                    rng.shuffle(indices)
+                    start = 0
+                # Из данных читаются только строки текущего пакета, в порядке возрастания (последовательный доступ к файлу)
+                batch_indices = np.sort(indices[start:start + batch_size])
+                batch_X, batch_Y = dataset.take(X, Y, batch_indices)
+            with profiling.phase(tr, "gradient"):
+                G = gradient_lf(loss_function, parameters, batch_X, batch_Y) if finite_difference else gradient_function(*parameters, batch_X, batch_Y)
+            start += batch_size
+            finite = np.all(np.isfinite(G))
+            if finite:
+                difference = step_alpha * G
+                parameters -= difference
+                if (i + 1) % loss_check_every == 0:
+                    with profiling.phase(tr, "loss"):
+                        loss = loss_function(*parameters, check_X, check_Y)
+                    n_loss += 1
+                    finite = np.isfinite(loss)
+            if not finite:
+                # Шаг привел в область переполнения: возврат в последнюю проверенную точку, скорость спуска уменьшается вдвое
+                parameters = good_parameters.copy()
+                n_rejected += 1
+                n_backtracks += 1
+                if n_backtracks > max_backtracks:
+                    stop_reason = STOP_NON_FINITE
+                    if not suppress_stdout:
+                        with profiling.phase(tr, "progress"):
+                            pb.print_progress_bar(n_iter - 1)
+                            print(f"Досрочный выход из-за переполнения. n_iter = {i}")
+                    break
+                step_alpha /= 2
+            elif (i + 1) % loss_check_every == 0:
+                n_backtracks = 0
+                good_parameters = parameters.copy()
+                if history:
+                    iterations.append(i + 1)
+                    loss_history.append(float(loss))
+                if tr is not None: tr.record_loss(i + 1, loss)
+                if loss + epsilon > best_loss:n_iter_no_change += loss_check_every
+                else: n_iter_no_change = 0
+                if n_iter_no_change >= max_n_iter_no_change:
+                    stop_reason = STOP_NO_CHANGE
+                    if not suppress_stdout:
+                        with profiling.phase(tr, "progress"):
+                            pb.print_progress_bar(n_iter - 1)
+                            print(f"Досрочный выход. n_iter = {i}")
+                    break
+                if loss < best_loss:
+                    best_loss = loss
+                    best_parameters = parameters.copy()
+            if not suppress_stdout:
+                with profiling.phase(tr, "progress"):
+                    pb.print_progress_bar(i)
+    if finite_difference: n_loss += 2 * len(parameters) * n_done
+    result = OptimizationResult("minibatch_stochastic_gradient_descent_lf", best_parameters, best_loss, n_done, stop_reason, n_loss, n_done, iterations, loss_history, tr,
+                                info={"alpha": step_alpha, "n_rejected": n_rejected})
+    return _finish(return_result, tr, result)
+
+def levenberg_marquardt_lf(loss_function, initial_parameters, alpha, n_iter, X, Y, epsilon=1e-06, residual_jacobian_function=None, suppress_stdout=False, history=False, return_result=False):
+    """
+    Алгоритм Левенберга-Марквардта для поиска локального минимума функции потерь вида среднего квадратов невязок
+    :param loss_function: функция потерь, минимум которой необходимо найти
+    :param initial_parameters: начальные значения параметров
+    :param alpha: начальный коэффициент затухания (чем больше, тем ближе шаг к градиентному спуску)
+    :param n_iter: количество итераций
+    :param X: матрица входных данных или dataset.Dataset
+    :param Y: матрица выходных данных (None, если X - Dataset)
+    :param epsilon: значение для остановки алгоритма, когда изменение по каждому параметру <= epsilon*(1 + |параметр|) (не обязательно)
+    :param residual_jacobian_function: функция с той же сигнатурой, что и функция потерь, возвращающая вектор невязок и его матрицу Якоби (не обязательно). По умолчанию используется атрибут residual_jacobian функции потерь
+    :param suppress_stdout: не выводить сообщения и индикатор прогресса
+    :param history: сохранять функцию потерь на каждой итерации
+    :param return_result: вернуть OptimizationResult вместо параметров
+    :return: значение параметров в предполагаемом минимуме функции или OptimizationResult
+    """
+    if residual_jacobian_function is None: residual_jacobian_function = getattr(loss_function, "residual_jacobian", None)
+    if residual_jacobian_function is None:
+        raise ValueError("Для метода Левенберга-Марквардта функция потерь должна иметь атрибут residual_jacobian")
+    parameters = np.array(initial_parameters, dtype=float)
+    damping = alpha
+    loss = loss_function(*parameters, X, Y)
+    iterations, loss_history = ([0], [float(loss)]) if history else (None, None)
+    n_loss = 1
+    n_done = 0
+    stop_reason = STOP_MAX_ITER
     if not suppress_stdout:
-        print("Расчет оптимальных параметров методом мини-пакетного стохастического градиентного спуска")
+        print("Расчет оптимальных параметров методом Левенберга-Марквардта")
         pb = ProgressBar(total=n_iter-1, prefix='Progress', suffix='Complete', length=50)
-    n_iter_no_change = 0
     for i in range(n_iter):
-        if start >= len(X):
-            indices = rng.choice(X.shape[0], size=len(X), replace=False)
-            shuffled_X = X[indices]
-            shuffled_Y = Y[indices]
-            start = 0
-        end = min(len(X), start + batch_size)
-        batch_X = shuffled_X[start:end]
-        batch_Y = shuffled_Y[start:end]
-        G = gradient_lf(loss_function, parameters, batch_X, batch_Y)
-        difference = alpha * G
-        parameters -= difference
-        start += batch_size
-        loss = loss_function(*parameters, X, Y)
-        if loss + epsilon > best_loss:n_iter_no_change += 1
-        else: n_iter_no_change = 0
-        if n_iter_no_change >= max_n_iter_no_change:
+        n_done = i + 1
+        r, J = residual_jacobian_function(*parameters, X, Y)
+        A = J.T @ J
+        g = J.T @ r
+        # Затухание масштабируется диагональю J^T J, чтобы шаг не зависел от масштаба параметров (k0 ~ 1e5, en ~ 1e4)
+        scale = np.diag(A).copy()
+        scale[scale <= 0] = 1
+        accepted = False
+        while damping < 1e16:
+            try:
+                step = np.linalg.solve(A + damping * np.diag(scale), -g)
+            except np.linalg.LinAlgError:
+                damping *= 10
+                continue
+            new_loss = loss_function(*(parameters + step), X, Y)
+            n_loss += 1
+            if np.isfinite(new_loss) and new_loss < loss:
+                accepted = True
+                break
+            damping *= 10
+        if not accepted or np.all(np.abs(step) <= epsilon * (1 + np.abs(parameters))):
+            if accepted:
+                parameters += step
+                loss = new_loss
+                stop_reason = STOP_SMALL_STEP
+            else:
+                stop_reason = STOP_NO_DESCENT
+            if not suppress_stdout:
+                pb.print_progress_bar(n_iter-1)
+                print(f"Досрочный выход. n_iter = {i}")
+            break
+        parameters += step
+        loss = new_loss
+        if history:
+            iterations.append(i + 1)
+            loss_history.append(float(loss))
+        damping = max(damping / 10, 1e-12)
+        if not suppress_stdout:
+            pb.print_progress_bar(i)
+    result = OptimizationResult("levenberg_marquardt_lf", parameters, loss, n_done, stop_reason, n_loss, n_done, iterations, loss_history, info={"damping": damping})
+    return _finish(return_result, None, result)
+
+def lbfgs_lf(loss_function, initial_parameters, alpha, n_iter, X, Y, epsilon=1e-06, gradient_function=None, memory=10, suppress_stdout=False, history=False, return_result=False):
+    """
+    Алгоритм L-BFGS (квазиньютоновский метод с ограниченной памятью) с поиском шага по условию Армихо
+    :param loss_function: функция потерь, минимум которой необходимо найти
+    :param initial_parameters: начальные значения параметров
+    :param alpha: длина первого шага вдоль антиградиента (далее шаг определяется приближением матрицы Гессе)
+    :param n_iter: количество итераций
+    :param X: матрица входных данных или dataset.Dataset
+    :param Y: матрица выходных данных (None, если X - Dataset)
+    :param epsilon: значение для остановки алгоритма, когда изменение по каждому параметру <= epsilon*(1 + |параметр|) (не обязательно)
+    :param gradient_function: функция градиента с той же сигнатурой, что и функция потерь (не обязательно). По умолчанию используется атрибут gradient функции потерь, а если его нет - формула центральной разности
+    :param memory: количество хранимых пар (изменение параметров, изменение градиента)
+    :param suppress_stdout: не выводить сообщения и индикатор прогресса
+    :param history: сохранять функцию потерь на каждой итерации
+    :param return_result: вернуть OptimizationResult вместо параметров
+    :return: значение параметров в предполагаемом минимуме функции или OptimizationResult
+    """
+    if gradient_function is None: gradient_function = getattr(loss_function, "gradient", None)
+    def grad(p): return gradient_lf(loss_function, p, X, Y) if gradient_function is None else np.asarray(gradient_function(*p, X, Y), dtype=float)
+    parameters = np.array(initial_parameters, dtype=float)
+    loss = loss_function(*parameters, X, Y)
+    G = grad(parameters)
+    iterations, loss_history = ([0], [float(loss)]) if history else (None, None)
+    n_loss = 1
+    n_gradient = 1
+    n_done = 0
+    stop_reason = STOP_MAX_ITER
+    s_arr = []
+    y_arr = []
+    if not suppress_stdout:
+        print("Расчет оптимальных параметров методом L-BFGS")
+        pb = ProgressBar(total=n_iter-1, prefix='Progress', suffix='Complete', length=50)
+    for i in range(n_iter):
+        n_done = i + 1
+        # Двухцикловая рекурсия: направление -H*G по сохраненным парам
+        q = G.copy()
+        rho_arr = [1 / (y_k @ s_k) for s_k, y_k in zip(s_arr, y_arr)]
+        a_arr = []
+        for s_k, y_k, rho in reversed(list(zip(s_arr, y_arr, rho_arr))):
+            a = rho * (s_k @ q)
+            q -= a * y_k
+            a_arr.append(a)
+        q *= (s_arr[-1] @ y_arr[-1]) / (y_arr[-1] @ y_arr[-1]) if s_arr else alpha
+        for (s_k, y_k, rho), a in zip(zip(s_arr, y_arr, rho_arr), reversed(a_arr)):
+            q += (a - rho * (y_k @ q)) * s_k
+        direction = -q
+        slope = G @ direction
+        if slope >= 0:
+            # Приближение матрицы Гессе испорчено - возврат к антиградиенту
+            s_arr, y_arr = [], []
+            direction = -alpha * G
+            slope = G @ direction
+        # Поиск шага с дроблением по условию Армихо
+        t = 1.0
+        for _ in range(50):
+            new_parameters = parameters + t * direction
+            new_loss = loss_function(*new_parameters, X, Y)
+            n_loss += 1
+            if np.isfinite(new_loss) and new_loss <= loss + 1e-4 * t * slope: break
+            t /= 2
+        else:
+            stop_reason = STOP_NO_DESCENT
+            if not suppress_stdout:
+                pb.print_progress_bar(n_iter-1)
+                print(f"Досрочный выход. n_iter = {i}")
+            break
+        step = new_parameters - parameters
+        new_G = grad(new_parameters)
+        n_gradient += 1
+        if step @ (new_G - G) > 1e-12 * np.linalg.norm(step) * np.linalg.norm(new_G - G):
+            s_arr.append(step)
+            y_arr.append(new_G - G)
+            if len(s_arr) > memory:
+                s_arr.pop(0)
+                y_arr.pop(0)
+        parameters, loss, G = new_parameters, new_loss, new_G
+        if history:
+            iterations.append(i + 1)
+            loss_history.append(float(loss))
+        if np.all(np.abs(step) <= epsilon * (1 + np.abs(parameters))):
+            stop_reason = STOP_SMALL_STEP
             if not suppress_stdout:
-                pb.print_progress_bar(n_iter - 1)
+                pb.print_progress_bar(n_iter-1)
                 print(f"Досрочный выход. n_iter = {i}")
             break
-        if loss < best_loss:
-            best_loss = loss
-            best_parameters = parameters.copy()
         if not suppress_stdout:
             pb.print_progress_bar(i)
-    return best_parameters
\ No newline at end of file
+    if gradient_function is None: n_loss += 2 * len(parameters) * n_gradient
+    result = OptimizationResult("lbfgs_lf", parameters, loss, n_done, stop_reason, n_loss, n_gradient, iterations, loss_history)
+    return _finish(return_result, None, result)
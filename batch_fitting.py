@@ -0,0 +1,167 @@
+import argparse
+import csv
+import multiprocessing
+import os
+import queue
+import sys
+import time
+from collections import deque
+import numpy as np
+from data_loader import load_dataset, is_cache_file
+from two_step_optimization import two_step_optimization, fit_temperature
+
+# Модели: столбцы файла данных (последний - концентрация глюкозы) и названия параметров в таблице результатов
+MODELS = {
+    "4_param": {"columns": ("g0", "temp", "time", "G"), "parameters": ("k0_1", "en1", "k0_2", "en2")},
+    "2_param": {"columns": ("g0", "time", "G"), "parameters": ("k1", "k2")},
+}
+# Расширения файлов данных при поиске в каталоге (см. data_loader.load_dataset)
+DATA_EXTENSIONS = (".csv", ".npy", ".bin", ".raw")
+# Столбцы таблицы результатов
+FIELDS = ("job", "name", "path", "model", "status", "error", "time", "loss", "n_iter", "stop_reason", "n_samples",
+          *MODELS["4_param"]["parameters"], *MODELS["2_param"]["parameters"])
+# Состояния заданий
+STATUS_OK = "ok"
+STATUS_ERROR = "error"
+STATUS_TIMEOUT = "timeout"
+
+
+def find_jobs(source, model="4_param"):
+    """
+    Список заданий из каталога с файлами данных или из файла-манифеста
+    :param source: каталог (все файлы с расширениями DATA_EXTENSIONS) или CSV-манифест со столбцами path и,
+    не обязательно, name и model (относительные пути отсчитываются от каталога манифеста)
+    :param model: модель по умолчанию ("4_param" или "2_param")
+    :return: список словарей с ключами name, path, model
+    """
+    if os.path.isdir(source):
+        jobs = []
+        for file_name in sorted(os.listdir(source)):
+            # Файлы .npy, которые создает load_dataset при чтении CSV, не являются отдельными наборами данных
+            if is_cache_file(file_name) or file_name.lower().endswith(".csv.npy") or not file_name.lower().endswith(DATA_EXTENSIONS): continue
+            jobs.append({"name": os.path.splitext(file_name)[0], "path": os.path.join(source, file_name), "model": model})
+        return jobs
+    base = os.path.dirname(os.path.abspath(source))
+    with open(source, newline="") as file:
+        return [{"name": row.get("name") or os.path.splitext(os.path.basename(row["path"]))[0],
+                 "path": os.path.join(base, row["path"]),
+                 "model": row.get("model") or model} for row in csv.DictReader(file) if row.get("path")]
+
+
+def fit_dataset(path, model="4_param", n_iter=50, cache_dir=None):
+    """
+    Подбор параметров для одного набора данных методом Левенберга-Марквардта из SGD.py: для модели с 4 параметрами -
+    двухэтапная оценка с совместным уточнением (см. two_step_optimization), для модели с 2 параметрами - подбор k1, k2
+    :param path: путь к файлу данных
+    :param model: модель ("4_param" или "2_param")
+    :param n_iter: количество итераций уточнения
+    :param cache_dir: каталог для файлов .npy, полученных из CSV (см. data_loader.load_dataset)
+    :return: SGD.OptimizationResult и количество образцов
+    """
+    if model not in MODELS: raise ValueError(f"Неизвестная модель: {model}")
+    x, y = load_dataset(path, MODELS[model]["columns"], cache_dir=cache_dir)
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    if len(y) == 0: raise ValueError("Нет данных")
+    if model == "4_param":
+        result = two_step_optimization(x, y, refine=True, n_iter=n_iter, suppress_stdout=True)
+    else:
+        result = fit_temperature(x, y, n_iter=n_iter)
+    if not np.isfinite(result.loss): raise FloatingPointError("Функция потерь не конечна (переполнение)")
+    return result, len(y)
+
+
+def _run_job(index, job, n_iter, cache_dir, results):
+    row = {"job": index, **job}
+    start = time.perf_counter()
+    try:
+        result, n_samples = fit_dataset(job["path"], job["model"], n_iter, cache_dir)
+        row.update(status=STATUS_OK, loss=float(result.loss), n_iter=result.n_iter, stop_reason=result.stop_reason, n_samples=n_samples,
+                   **dict(zip(MODELS[job["model"]]["parameters"], map(float, result.parameters))))
+    except Exception as error:
+        row.update(status=STATUS_ERROR, error=f"{type(error).__name__}: {error}")
+    row["time"] = time.perf_counter() - start
+    results.put(row)
+
+
+def run_batch(jobs, output, n_workers=None, timeout=None, n_iter=50, cache_dir=None, suppress_stdout=False):
+    """
+    Подбор параметров для многих наборов данных. Каждое задание выполняется в отдельном процессе, одновременно -
+    не больше n_workers процессов. Строки таблицы результатов дописываются в CSV-файл по мере завершения заданий.
+    Ошибка или превышение времени одного задания записывается в его строку и не прерывает остальные
+    :param jobs: список заданий (см. find_jobs)
+    :param output: путь к CSV-файлу результатов
+    :param n_workers: максимальное количество одновременно работающих процессов (None - по числу ядер)
+    :param timeout: максимальное время одного задания в секундах (None - без ограничения)
+    :param n_iter: количество итераций уточнения
+    :param cache_dir: каталог для файлов .npy, полученных из CSV (None - каталог каждого CSV-файла)
+    :param suppress_stdout: не выводить сообщения о завершенных заданиях
+    :return: словарь с количеством заданий по состояниям
+    """
+    if n_workers is None: n_workers = os.cpu_count()
+    context = multiprocessing.get_context()
+    results = context.Queue()
+    waiting = deque(enumerate(jobs))
+    running = {}
+    counts = {STATUS_OK: 0, STATUS_ERROR: 0, STATUS_TIMEOUT: 0}
+    with open(output, "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=FIELDS, extrasaction="ignore")
+        writer.writeheader()
+
+        def finish(row):
+            process, _ = running.pop(row["job"])
+            process.join()
+            writer.writerow(row)
+            file.flush()
+            counts[row["status"]] += 1
+            if not suppress_stdout:
+                done = sum(counts.values())
+                message = f"loss = {row['loss']:.4}" if row["status"] == STATUS_OK else f"{row['status']}: {row.get('error', '')}"
+                print(f"[{done}/{len(jobs)}] {row['name']}: {message}")
+
+        try:
+            while waiting or running:
+                while waiting and len(running) < n_workers:
+                    index, job = waiting.popleft()
+                    process = context.Process(target=_run_job, args=(index, job, n_iter, cache_dir, results), daemon=True)
+                    process.start()
+                    running[index] = (process, time.perf_counter())
+                try:
+                    row = results.get(timeout=0.1)
+                    # Результат задания, уже снятого по времени, не записывается повторно
+                    if row["job"] in running: finish(row)
+                except queue.Empty:
+                    pass
+                now = time.perf_counter()
+                for index, (process, start) in list(running.items()):
+                    job = jobs[index]
+                    if timeout is not None and now - start > timeout:
+                        process.terminate()
+                        finish({"job": index, **job, "status": STATUS_TIMEOUT, "error": f"превышено время {timeout} с", "time": now - start})
+                    elif not process.is_alive() and process.exitcode != 0:
+                        # Процесс завершился аварийно, не передав результат (например, нехватка памяти)
+                        finish({"job": index, **job, "status": STATUS_ERROR, "error": f"код завершения процесса {process.exitcode}", "time": now - start})
+        finally:
+            for process, _ in running.values():
+                process.terminate()
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Подбор параметров кинетики для многих наборов данных")
+    parser.add_argument("source", help="каталог с файлами данных или CSV-манифест (столбцы path, name, model)")
+    parser.add_argument("--output", default="results.csv", help="CSV-файл для таблицы результатов")
+    parser.add_argument("--model", default="4_param", choices=tuple(MODELS), help="модель по умолчанию")
+    parser.add_argument("--workers", type=int, default=None, help="количество одновременно работающих процессов")
+    parser.add_argument("--timeout", type=float, default=None, help="максимальное время одного задания в секундах")
+    parser.add_argument("--n-iter", type=int, default=50, help="количество итераций уточнения")
+    parser.add_argument("--cache-dir", default=None, help="каталог для файлов .npy, полученных из CSV (по умолчанию - рядом с CSV)")
+    args = parser.parse_args(argv)
+
+    jobs = find_jobs(args.source, args.model)
+    counts = run_batch(jobs, args.output, args.workers, args.timeout, args.n_iter, args.cache_dir)
+    print(f"Успешно: {counts[STATUS_OK]}, ошибок: {counts[STATUS_ERROR]}, превышено время: {counts[STATUS_TIMEOUT]}")
+    return 0 if counts[STATUS_OK] == len(jobs) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
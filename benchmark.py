@@ -0,0 +1,149 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import numpy as np
+import optimization_4_param as o4p
+import cache
+from dif_eq_lib import find_g as odeint_find_g
+from SGD import gradient_lf, gradient_descent_lf, stochastic_gradient_descent_lf, minibatch_stochastic_gradient_descent_lf, levenberg_marquardt_lf, lbfgs_lf
+from global_optimization import make_grid, run_starts, rank_results
+
+# Параметры из статьи, в окрестности которых измеряется время
+REAL_PARAMETERS = [5.91e5, 10733, 2.07, 2224]
+# Допустимое относительное замедление медианного времени по сравнению с эталоном
+THRESHOLD = 0.2
+
+
+def measure(function, repeat=5):
+    """
+    Измерение времени выполнения функции
+    :param function: функция без аргументов
+    :param repeat: количество повторов
+    :return: словарь с медианным и минимальным временем в секундах и количеством повторов
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return {"median": float(np.median(times)), "min": float(np.min(times)), "repeat": repeat}
+
+
+def git_commit():
+    """
+    Текущий коммит репозитория, в котором находится benchmark.py (независимо от текущего каталога)
+    :return: хеш коммита и признак наличия незафиксированных изменений (None, если git недоступен)
+    """
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True, cwd=cwd).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True, text=True, check=True, cwd=cwd).stdout.strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+def run_benchmarks(quick=False):
+    """
+    Измерение времени решателей ДУ, функции потерь, градиента, оптимизаторов и глобальной оптимизации
+    :param quick: уменьшенный набор (меньше повторов и размеров данных)
+    :return: словарь результатов по названиям измерений
+    """
+    repeat = 3 if quick else 5
+    x, y = o4p.generate_data(42)
+    x, y = np.array(x), np.array(y)
+    results = {}
+    # Решение ДУ для одного образца
+    sample = (10, 333.15, 40)
+    for h in (0.1, 0.5):
+        results[f"find_g/rk4_h{h}"] = measure(lambda: o4p.find_g(*REAL_PARAMETERS, *sample, h=h), repeat)
+    for method in ("analytic", "dopri5"):
+        results[f"find_g/{method}"] = measure(lambda: o4p.find_g(*REAL_PARAMETERS, *sample, method=method), repeat)
+    # Кэш очищается перед каждым повтором (расчет траектории) или заполнен заранее (только поиск в кэше)
+    results["find_g/cached_cold"] = measure(lambda: (cache.cache_clear(), o4p.find_g(*REAL_PARAMETERS, *sample, method="cached")), repeat)
+    o4p.find_g(*REAL_PARAMETERS, *sample, method="cached")
+    results["find_g/cached_warm"] = measure(lambda: o4p.find_g(*REAL_PARAMETERS, *sample, method="cached"), repeat)
+    results["find_g/odeint"] = measure(lambda: odeint_find_g(*REAL_PARAMETERS, *sample), repeat)
+    # Функция потерь для разных размеров данных
+    for factor in ((1, 10) if quick else (1, 10, 100)):
+        X, Y = np.tile(x, (factor, 1)), np.tile(y, factor)
+        for method in ("rk4", "analytic", "grouped"):
+            results[f"loss_function/{method}/n{len(X)}"] = measure(lambda: o4p.loss_function(*REAL_PARAMETERS, X, Y, method=method), repeat)
+    # Градиент
+    results["gradient/central_difference"] = measure(lambda: gradient_lf(o4p.loss_function, np.array(REAL_PARAMETERS, dtype=float), x, y), repeat)
+    results["gradient/sensitivity"] = measure(lambda: o4p.gradient_function(*REAL_PARAMETERS, x, y), repeat)
+    # Оптимизаторы (фиксированное количество итераций из одной начальной точки, без вывода в консоль)
+    initial_parameters = o4p.to_log_parameters([1e5, 9000, 1, 1500])
+    n_iter = 10 if quick else 50
+    optimizers = {
+        "gradient_descent_lf": lambda: gradient_descent_lf(o4p.log_loss_function, initial_parameters.copy(), 1e-2, n_iter, x, y, suppress_stdout=True),
+        "stochastic_gradient_descent_lf": lambda: stochastic_gradient_descent_lf(o4p.log_loss_function, initial_parameters.copy(), 1e-2, n_iter, x, y, max_n_iter_no_change=n_iter, suppress_stdout=True),
+        "minibatch_stochastic_gradient_descent_lf": lambda: minibatch_stochastic_gradient_descent_lf(o4p.log_loss_function, initial_parameters.copy(), 1e-2, n_iter, x, y, 20, max_n_iter_no_change=n_iter, suppress_stdout=True),
+        "levenberg_marquardt_lf": lambda: levenberg_marquardt_lf(o4p.log_loss_function, initial_parameters, 1e-3, n_iter, x, y, suppress_stdout=True),
+        "lbfgs_lf": lambda: lbfgs_lf(o4p.log_loss_function, initial_parameters, 1e-2, n_iter, x, y, suppress_stdout=True),
+    }
+    for name, optimizer in optimizers.items():
+        results[f"optimizer/{name}"] = measure(optimizer, repeat)
+    # Спуски из точек небольших сеток глобальной оптимизации
+    for num_of_points in ((2,) if quick else (2, 3)):
+        starts = make_grid(0, 20000, num_of_points)
+        results[f"global_optimization/grid{num_of_points}"] = measure(lambda: rank_results(run_starts(starts, x, y, 0.0001, 5, 5, 20)), 1)
+    return results
+
+
+def compare(results, baseline, threshold=THRESHOLD):
+    """
+    Сравнение с эталонными результатами
+    :param results: текущие результаты (см. run_benchmarks)
+    :param baseline: эталонные результаты
+    :param threshold: допустимое относительное замедление медианного времени
+    :return: список замедлившихся измерений (название, эталонное время, текущее время)
+    """
+    regressions = []
+    for name, result in results.items():
+        if name in baseline and result["median"] > baseline[name]["median"] * (1 + threshold):
+            regressions.append((name, baseline[name]["median"], result["median"]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Измерение производительности решателей, функций потерь и оптимизаторов")
+    parser.add_argument("--output", default="benchmark.json", help="файл JSON для результатов")
+    parser.add_argument("--baseline", help="файл JSON с эталонными результатами для сравнения")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD, help="допустимое относительное замедление")
+    parser.add_argument("--quick", action="store_true", help="уменьшенный набор измерений")
+    args = parser.parse_args(argv)
+
+    commit, dirty = git_commit()
+    results = run_benchmarks(args.quick)
+    report = {
+        "commit": commit,
+        "dirty": dirty,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "results": results,
+    }
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+    for name, result in results.items():
+        print(f"{name:60s} {result['median']*1e3:12.3f} мс")
+
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline["results"], args.threshold)
+        print(f"\nСравнение с {baseline.get('commit')}:")
+        for name, old, new in regressions:
+            print(f"Замедление {name}: {old*1e3:.3f} мс -> {new*1e3:.3f} мс ({new/old - 1:+.0%})")
+        if not regressions: print("Замедлений нет")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
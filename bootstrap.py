@@ -0,0 +1,93 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from console_progressbar import ProgressBar
+from SGD import levenberg_marquardt_lf
+import dataset
+from common import worker_data, init_worker
+
+
+def _run_chunk(seeds):
+    return [refit(seed, **worker_data) for seed in seeds]
+
+
+def refit(seed, loss_function, parameters, x, y, optimizer, alpha, n_iter, optimizer_parameters, transform):
+    """
+    Один повтор бутстрэпа: выборка с возвращением того же размера и спуск из оптимума по полным данным
+    :param seed: numpy.random.SeedSequence (или число) для генератора этого повтора
+    :param loss_function: функция потерь
+    :param parameters: оптимум по полным данным (начальная точка спуска)
+    :param x: матрица входных данных
+    :param y: вектор экспериментальных данных
+    :param optimizer: оптимизатор из SGD.py
+    :param alpha: параметр alpha оптимизатора
+    :param n_iter: количество итераций
+    :param optimizer_parameters: дополнительные именованные параметры оптимизатора
+    :param transform: функция перехода от параметров спуска к параметрам отчета (не обязательно)
+    :return: найденные параметры (nan, если спуск не нашел точку с конечной функцией потерь)
+    """
+    rng = np.random.default_rng(seed)
+    index = rng.integers(0, len(x), len(x))
+    result = optimizer(loss_function, parameters, alpha, n_iter, *dataset.take(x, y, index), suppress_stdout=True, return_result=True, **optimizer_parameters)
+    found = np.asarray(result.parameters if transform is None else transform(result.parameters), dtype=float)
+    return found if np.isfinite(result.loss) else np.full(len(found), np.nan)
+
+
+def bootstrap(loss_function, parameters, x, y, n_bootstrap=1000, confidence=0.95, optimizer=levenberg_marquardt_lf, alpha=1e-3, n_iter=50,
+              optimizer_parameters=None, transform=None, seed=0, n_workers=1, chunk_size=None, suppress_stdout=False):
+    """
+    Доверительные интервалы параметров методом бутстрэпа: параметры подбираются заново на n_bootstrap выборках
+    с возвращением из данных, каждый спуск начинается в оптимуме по полным данным, поэтому сходится за несколько итераций.
+    Генератор каждого повтора создается из своей ветви SeedSequence(seed), поэтому результат не зависит от
+    количества процессов и порядка выполнения.
+    Пример для модели с 4 параметрами (спуск в логарифмических координатах):
+    bootstrap(o4p.log_loss_function, o4p.to_log_parameters(parameters), x, y, transform=o4p.to_physical_parameters)
+    :param loss_function: функция потерь
+    :param parameters: оптимум по полным данным
+    :param x: матрица входных данных или dataset.Dataset
+    :param y: вектор экспериментальных данных (None, если x - Dataset)
+    :param n_bootstrap: количество повторов
+    :param confidence: доверительная вероятность
+    :param optimizer: оптимизатор из SGD.py
+    :param alpha: параметр alpha оптимизатора
+    :param n_iter: количество итераций в каждом повторе
+    :param optimizer_parameters: дополнительные именованные параметры оптимизатора (не обязательно, например batch_size)
+    :param transform: функция перехода от параметров спуска к параметрам отчета (не обязательно)
+    :param seed: значения для инициализации генераторов случайных чисел
+    :param n_workers: количество процессов (1 - без пула, None - по числу ядер)
+    :param chunk_size: количество повторов в одной задаче для процесса (не обязательно)
+    :param suppress_stdout: не выводить сообщения и индикатор прогресса
+    :return: нижние и верхние границы процентильных интервалов и матрица оценок размера (n_bootstrap, количество параметров)
+    (строки nan для повторов, в которых спуск не нашел точку с конечной функцией потерь)
+    """
+    if n_workers is None: n_workers = os.cpu_count()
+    x, y = dataset.as_arrays(x, y)
+    parameters = np.asarray(parameters, dtype=float)
+    context = dict(loss_function=loss_function, parameters=parameters, x=x, y=y, optimizer=optimizer, alpha=alpha, n_iter=n_iter,
+                   optimizer_parameters=optimizer_parameters or {}, transform=transform)
+    seeds = np.random.SeedSequence(seed).spawn(n_bootstrap)
+    estimates = [None] * n_bootstrap
+    pb = None
+    if not suppress_stdout:
+        print(f"Бутстрэп: {n_bootstrap} повторов")
+        pb = ProgressBar(total=max(n_bootstrap - 1, 1), prefix="Progress", suffix='Complete', length=50)
+    count = 0
+    if n_workers <= 1:
+        for i in range(n_bootstrap):
+            estimates[i] = refit(seeds[i], **context)
+            if pb is not None: pb.print_progress_bar(i)
+    else:
+        if chunk_size is None: chunk_size = max(1, -(-n_bootstrap // (4 * n_workers)))
+        with ProcessPoolExecutor(n_workers, initializer=init_worker, initargs=(context,)) as executor:
+            futures = {executor.submit(_run_chunk, seeds[j:j + chunk_size]): j for j in range(0, n_bootstrap, chunk_size)}
+            for future in as_completed(futures):
+                for i, found in enumerate(future.result(), start=futures[future]):
+                    estimates[i] = found
+                    if pb is not None: pb.print_progress_bar(count)
+                    count += 1
+    estimates = np.array(estimates)
+    failed = np.isnan(estimates).any(axis=1)
+    if np.all(failed): raise RuntimeError("Все повторы бутстрэпа прервались из-за переполнения")
+    lower, upper = np.percentile(estimates[~failed], [50 * (1 - confidence), 50 * (1 + confidence)], axis=0)
+    if not suppress_stdout and np.any(failed): print(f"Прерванных повторов: {np.count_nonzero(failed)}")
+    return lower, upper, estimates
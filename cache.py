@@ -0,0 +1,104 @@
+from bisect import bisect_left
+from functools import lru_cache
+from functions import find_k
+import profiling
+
+# Количество значащих цифр, до которого округляются ключи кэша. Значения, отличающиеся только
+# погрешностью вычислений с плавающей точкой, попадают в одну запись
+DIGITS = 14
+# Максимальное количество записей в каждом кэше. Траектория занимает до time/h значений,
+# поэтому размер ограничен, чтобы память не росла во время долгой глобальной оптимизации
+MAXSIZE = 1024
+
+
+def quantize(value, digits=DIGITS):
+    """
+    Округление числа до заданного количества значащих цифр для использования в ключе кэша
+    :param value: число
+    :param digits: количество значащих цифр
+    :return: округленное число
+    """
+    return float(f"{value:.{digits}g}")
+
+
+def _find_k(k0, en, temp):
+    return find_k(k0, en, temp)
+
+
+def _trajectory(k1, k2, g0, h):
+    # Моменты времени и значения концентрации на сетке метода Рунге-Кутты, достраиваются по мере запросов
+    return [0], [g0]
+
+
+def set_maxsize(maxsize):
+    """
+    Изменение размера кэшей (содержимое кэшей при этом очищается)
+    :param maxsize: максимальное количество записей в каждом кэше
+    """
+    global find_k_cache, trajectory_cache
+    find_k_cache = lru_cache(maxsize=maxsize)(_find_k)
+    trajectory_cache = lru_cache(maxsize=maxsize)(_trajectory)
+
+
+set_maxsize(MAXSIZE)
+
+
+def cached_find_k(k0, en, temp):
+    """
+    Расчет константы скорости реакции (см. functions.find_k) с кэшированием по (k0, en, temp)
+    :param k0: пред экспоненциальный фактор
+    :param en: энергия активации
+    :param temp: температура
+    :returns: константа скорости реакции для заданных значений
+    """
+    return find_k_cache(quantize(k0), quantize(en), quantize(temp))
+
+
+def cached_rk4_g(k1, k2, g0, time, h):
+    """
+    Метод Рунге-Кутты четвертого порядка с кэшированием траектории по (k1, k2, g0, h).
+    Траектория интегрируется один раз и только продлевается, если запрошено более позднее время,
+    поэтому все моменты времени для одного начального условия берутся из одного интегрирования.
+    Количество шагов то же, что и в цикле while t_i < time у find_g
+    :param k1: константа скорости реакции глюкозы
+    :param k2: константа скорости реакции фруктозы
+    :param g0: начальная концентрация глюкозы при t = 0
+    :param time: момент времени t
+    :param h: шаг метода Рунге-Кутты
+    :returns: концентрацию глюкозы в момент времени t
+    """
+    k1, k2, g0 = quantize(k1), quantize(k2), quantize(g0)
+    times, values = trajectory_cache(k1, k2, g0, h)
+    if times[-1] < time:
+        # Функция расчета производной концентрации глюкозы по времени
+        def f(g): return k2 * (g0 - g) - k1 * g
+        t_i = times[-1]
+        G_i = values[-1]
+        n_known = len(times)
+        while t_i < time:
+            t_i += h
+            K1 = f(G_i)
+            K2 = f(G_i + h/2*K1)
+            K3 = f(G_i + h/2*K2)
+            K4 = f(G_i + h*K3)
+            G_i += h/6*(K1+2*K2+2*K3+K4)
+            times.append(t_i)
+            values.append(G_i)
+        profiling.count("rk4_steps", len(times) - n_known)
+    return values[bisect_left(times, time)]
+
+
+def cache_info():
+    """
+    Статистика кэшей
+    :return: словарь с количеством попаданий (hits), промахов (misses) и записей (currsize) для каждого кэша
+    """
+    return {"find_k": find_k_cache.cache_info()._asdict(), "trajectory": trajectory_cache.cache_info()._asdict()}
+
+
+def cache_clear():
+    """
+    Очистка кэшей и счетчиков
+    """
+    find_k_cache.cache_clear()
+    trajectory_cache.cache_clear()
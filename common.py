@@ -0,0 +1,44 @@
+import os
+import numpy as np
+
+# Данные, общие для всех задач в процессе-исполнителе пула. Заполняются один раз при запуске процесса (init_worker),
+# чтобы набор данных не передавался заново вместе с каждой задачей
+worker_data = {}
+
+
+def init_worker(data):
+    """
+    Инициализатор процесса-исполнителя: ProcessPoolExecutor(..., initializer=init_worker, initargs=(data,))
+    :param data: словарь с данными, общими для всех задач (функция потерь, x, y, параметры)
+    """
+    worker_data.clear()
+    worker_data.update(data)
+
+
+def atomic_save(path, write):
+    """
+    Запись файла через временный файл, который затем заменяет старый, поэтому прерывание во время записи
+    не оставляет испорченный файл. При ошибке временный файл удаляется
+    :param path: путь к файлу
+    :param write: функция, записывающая содержимое в файл по переданному ей пути (временному)
+    """
+    tmp_path = path + ".tmp"
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+        raise
+
+
+def save_npz(path, **arrays):
+    """
+    Атомарная запись массивов в файл .npz (см. atomic_save)
+    :param path: путь к файлу
+    :param arrays: именованные массивы
+    """
+    def write(tmp_path):
+        # np.savez дописывает расширение .npz к пути, поэтому запись идет в открытый файл
+        with open(tmp_path, "wb") as file:
+            np.savez(file, **arrays)
+    atomic_save(path, write)
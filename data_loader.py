@@ -0,0 +1,135 @@
+import csv
+import hashlib
+import os
+import re
+from itertools import islice
+import numpy as np
+from common import atomic_save
+
+# Названия столбцов экспериментальных данных по умолчанию: начальная концентрация, температура, время, концентрация
+COLUMNS = ("g0", "temp", "time", "G")
+# Имя файла .npy, в который load_dataset преобразует CSV-файл: <имя CSV>.<ключ>.npy
+_CACHE_NAME = re.compile(r"\.csv\.[0-9a-f]{16}\.npy$", re.IGNORECASE)
+
+
+def _is_number(value):
+    try:
+        float(value)
+        return True
+    except ValueError:
+        return False
+
+
+def csv_to_npy(csv_path, npy_path, columns=COLUMNS, chunk_size=100000, dtype=np.float64, delimiter=","):
+    """
+    Потоковое преобразование CSV-файла в файл .npy. Файл читается пакетами по chunk_size строк и записывается
+    в отображенный в память массив, поэтому одновременно в памяти хранится только один пакет
+    :param csv_path: путь к CSV-файлу
+    :param npy_path: путь к создаваемому файлу .npy
+    :param columns: названия (если в файле есть заголовок) или номера используемых столбцов
+    :param chunk_size: количество строк в одном пакете
+    :param dtype: тип данных результата (np.float64 или np.float32)
+    :param delimiter: разделитель столбцов
+    :return: количество записанных строк
+    """
+    with open(csv_path, newline="") as file:
+        reader = csv.reader(file, delimiter=delimiter)
+        first = next(reader, None)
+        has_header = first is not None and not all(_is_number(value) for value in first)
+        n_rows = sum(1 for row in reader if row) + (0 if has_header or first is None else 1)
+    if has_header:
+        header = [name.strip() for name in first]
+        index = [header.index(column) if isinstance(column, str) else column for column in columns]
+    else:
+        index = [column for column in columns if not isinstance(column, str)] or list(range(len(columns)))
+    data = np.lib.format.open_memmap(npy_path, mode="w+", dtype=dtype, shape=(n_rows, len(index)))
+    with open(csv_path, newline="") as file:
+        reader = (row for row in csv.reader(file, delimiter=delimiter) if row)
+        if has_header: next(reader)
+        start = 0
+        while True:
+            chunk = list(islice(reader, chunk_size))
+            if not chunk: break
+            data[start:start + len(chunk)] = np.array(chunk)[:, index].astype(dtype)
+            start += len(chunk)
+    data.flush()
+    del data
+    return n_rows
+
+
+def load_npy(npy_path):
+    """
+    Отображение файла .npy в память без чтения всего файла
+    :param npy_path: путь к файлу .npy
+    :return: массив numpy.memmap, строки которого содержат значения столбцов
+    """
+    return np.load(npy_path, mmap_mode="r")
+
+
+def load_binary(path, n_columns=len(COLUMNS), dtype=np.float64):
+    """
+    Отображение в память двоичного файла без заголовка (значения записаны подряд построчно)
+    :param path: путь к файлу
+    :param n_columns: количество столбцов
+    :param dtype: тип данных в файле
+    :return: массив numpy.memmap размера (n_rows, n_columns)
+    """
+    return np.memmap(path, dtype=dtype, mode="r").reshape(-1, n_columns)
+
+
+def split_xy(data):
+    """
+    Разделение таблицы на входные данные и экспериментальные значения без копирования
+    :param data: массив, последний столбец которого содержит концентрацию глюкозы
+    :return: матрица входных данных x и вектор экспериментальных данных y (представления исходного массива)
+    """
+    return data[:, :-1], data[:, -1]
+
+
+def cache_path(path, columns=COLUMNS, dtype=np.float64, cache_dir=None):
+    """
+    Путь к файлу .npy, в который преобразуется CSV-файл. Ключ в имени зависит от полного пути к CSV, столбцов и типа данных,
+    поэтому разные наборы столбцов и типы не читают файлы друг друга
+    :param path: путь к CSV-файлу
+    :param columns: названия или номера столбцов
+    :param dtype: тип данных
+    :param cache_dir: каталог для файлов .npy (None - каталог CSV-файла)
+    :return: путь к файлу .npy
+    """
+    key = repr((os.path.abspath(path), tuple(columns), np.dtype(dtype).str))
+    name = f"{os.path.basename(path)}.{hashlib.sha256(key.encode()).hexdigest()[:16]}.npy"
+    return os.path.join(os.path.dirname(path) if cache_dir is None else cache_dir, name)
+
+
+def is_cache_file(path):
+    """
+    :return: True, если файл создан load_dataset при преобразовании CSV (не является отдельным набором данных)
+    """
+    return _CACHE_NAME.search(os.path.basename(path)) is not None
+
+
+def load_dataset(path, columns=COLUMNS, chunk_size=100000, dtype=np.float64, cache_dir=None):
+    """
+    Загрузка экспериментальных данных для функций потерь и оптимизаторов SGD.py. Файлы .npy отображаются в память,
+    двоичные файлы (.bin, .raw) - тоже, а CSV-файл один раз преобразуется в .npy (см. cache_path)
+    и повторно - только если CSV изменился
+    :param path: путь к файлу
+    :param columns: названия или номера столбцов для CSV, последний столбец - концентрация глюкозы
+    :param chunk_size: количество строк в одном пакете при чтении CSV
+    :param dtype: тип данных
+    :param cache_dir: каталог для файлов .npy, полученных из CSV (None - каталог CSV-файла; нужен, если он только для чтения)
+    :return: матрица входных данных x и вектор экспериментальных данных y
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".npy":
+        data = load_npy(path)
+    elif extension in (".bin", ".raw"):
+        data = load_binary(path, len(columns), dtype)
+    else:
+        npy_path = cache_path(path, columns, dtype, cache_dir)
+        if not os.path.exists(npy_path) or os.path.getmtime(npy_path) < os.path.getmtime(path):
+            if cache_dir is not None: os.makedirs(cache_dir, exist_ok=True)
+            # Запись во временный файл, чтобы прерванное преобразование не оставило неполный .npy
+            atomic_save(npy_path, lambda tmp_path: csv_to_npy(path, tmp_path, columns, chunk_size, dtype))
+        data = load_npy(npy_path)
+    return split_xy(data)
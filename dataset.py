@@ -0,0 +1,169 @@
+import numpy as np
+from functions import group_samples
+from data_loader import COLUMNS, load_dataset
+
+
+class Dataset:
+    """
+    Экспериментальные данные в виде непрерывных столбцов g0, temp, time, G одного типа (float64 или float32).
+    Столбцы - представления одного массива data размера (4, N), поэтому функции потерь читают их без преобразований
+    (столбцы float32 не копируются в float64, см. functions.as_float; сами вычисления идут в float64).
+    Функции потерь optimization_2_param.py, optimization_4_param.py и оптимизаторы SGD.py принимают Dataset
+    вместо x, тогда y = None
+    """
+
+    def __init__(self, g0, temp, time, G, dtype=np.float64):
+        """
+        :param g0: вектор начальных концентраций глюкозы
+        :param temp: вектор температур (None для модели с 2 параметрами, тогда столбец заполняется nan)
+        :param time: вектор моментов времени
+        :param G: вектор экспериментальных концентраций глюкозы
+        :param dtype: тип данных столбцов (np.float64 или np.float32)
+        """
+        data = np.empty((4, len(G)), dtype=dtype)
+        data[0] = g0
+        data[1] = np.nan if temp is None else temp
+        data[2] = time
+        data[3] = G
+        has_temp = temp is not None
+        # Траектории - группы образцов с общими начальными условиями (g0 и температура)
+        groups = group_samples(data[0], data[1]) if has_temp else group_samples(data[0])
+        self._init(data, has_temp, groups)
+
+    def _init(self, data, has_temp, groups):
+        self.data = data
+        self.has_temp = has_temp
+        self.groups = groups
+        self.g0, self.temp, self.time, self.G = data
+        self._order = None
+
+    @classmethod
+    def _view(cls, data, has_temp, groups):
+        # Подмножество образцов с уже известными группами (без повторной группировки)
+        dataset = cls.__new__(cls)
+        dataset._init(data, has_temp, groups)
+        return dataset
+
+    @classmethod
+    def from_xy(cls, x, y, dtype=np.float64):
+        """
+        Набор данных из матрицы входных данных и вектора экспериментальных данных (см. generate_data)
+        :param x: матрица, строчки которой содержат g0, temp, time (модель с 4 параметрами) или g0, time (модель с 2 параметрами)
+        :param y: вектор экспериментальных концентраций глюкозы
+        :param dtype: тип данных столбцов
+        :return: Dataset
+        """
+        x = np.asarray(x, dtype=dtype).reshape(len(y), -1)
+        if x.shape[1] == 3: return cls(x[:, 0], x[:, 1], x[:, 2], y, dtype)
+        if x.shape[1] == 2: return cls(x[:, 0], None, x[:, 1], y, dtype)
+        raise ValueError(f"Ожидалось 2 или 3 столбца входных данных, получено {x.shape[1]}")
+
+    @classmethod
+    def from_file(cls, path, columns=COLUMNS, dtype=np.float64, cache_dir=None):
+        """
+        Загрузка набора данных из файла (см. data_loader.load_dataset)
+        :param path: путь к файлу
+        :param columns: названия или номера столбцов, последний столбец - концентрация глюкозы
+        :param dtype: тип данных столбцов
+        :param cache_dir: каталог для файлов .npy, полученных из CSV (не обязательно)
+        :return: Dataset
+        """
+        return cls.from_xy(*load_dataset(path, columns, dtype=dtype, cache_dir=cache_dir), dtype=dtype)
+
+    @property
+    def order(self):
+        """
+        Порядок образцов по траекториям и по возрастанию времени внутри траектории (для решателя "grouped",
+        см. kernels.grouped_rk4_g). Считается при первом обращении и сохраняется
+        """
+        if self._order is None: self._order = np.lexsort((self.time, self.groups[1]))
+        return self._order
+
+    @property
+    def x(self):
+        """
+        Матрица входных данных в формате generate_data (для модели с 4 параметрами - представление без копирования)
+        """
+        return self.data[:3].T if self.has_temp else np.stack((self.g0, self.time), axis=-1)
+
+    @property
+    def y(self):
+        """
+        Вектор экспериментальных концентраций глюкозы (представление без копирования)
+        """
+        return self.G
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    def astype(self, dtype):
+        """
+        :return: копия набора данных с другим типом столбцов (группы не пересчитываются)
+        """
+        return Dataset._view(self.data.astype(dtype), self.has_temp, self.groups)
+
+    def __len__(self):
+        return self.data.shape[1]
+
+    def __getitem__(self, index):
+        """
+        Подмножество образцов: срез - представление без копирования, массив номеров (мини-пакет) - копия только
+        выбранных образцов, один номер - набор из одного образца
+        """
+        if np.ndim(index) == 0 and not isinstance(index, slice): index = [index]
+        keys, group = self.groups
+        return Dataset._view(self.data[:, index], self.has_temp, (keys, group[index]))
+
+    def __repr__(self):
+        return f"Dataset({len(self)} образцов, {len(self.groups[0])} траекторий, {self.dtype})"
+
+
+def columns(x, y, n_columns):
+    """
+    Векторы столбцов входных данных и экспериментальных данных для функций потерь
+    :param x: Dataset, матрица входных данных или одна строчка
+    :param y: вектор экспериментальных данных или одно значение (None, если x - Dataset)
+    :param n_columns: 3 для модели с 4 параметрами (g0, temp, time), 2 для модели с 2 параметрами (g0, time)
+    :return: кортеж векторов столбцов и вектор экспериментальных данных
+    """
+    if isinstance(x, Dataset): return ((x.g0, x.temp, x.time) if n_columns == 3 else (x.g0, x.time)), x.G
+    x = np.atleast_2d(np.asarray(x, dtype=float))
+    return tuple(x.T), np.atleast_1d(np.asarray(y, dtype=float))
+
+
+def groups(x):
+    """
+    :param x: Dataset или матрица входных данных
+    :return: предвычисленные группы образцов Dataset (см. functions.group_samples) или None
+    """
+    return x.groups if isinstance(x, Dataset) else None
+
+
+def order(x):
+    """
+    :param x: Dataset или матрица входных данных
+    :return: порядок образцов Dataset по траекториям и времени (см. Dataset.order) или None
+    """
+    return x.order if isinstance(x, Dataset) else None
+
+
+def as_arrays(x, y):
+    """
+    Приведение входных данных к массивам без копирования: Dataset возвращается как есть (y = None),
+    списки преобразуются в массивы, массивы (в том числе отображенные в память) не копируются
+    :return: x и y
+    """
+    if isinstance(x, Dataset): return x, None
+    return np.asarray(x), np.asarray(y)
+
+
+def take(x, y, index):
+    """
+    Выбор образцов по номерам
+    :param x: Dataset или матрица входных данных
+    :param y: вектор экспериментальных данных (None, если x - Dataset)
+    :param index: номер, срез или массив номеров
+    :return: x и y для выбранных образцов
+    """
+    return x[index], None if y is None else y[index]
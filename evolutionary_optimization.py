@@ -0,0 +1,229 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from console_progressbar import ProgressBar
+from SGD import OptimizationResult, STOP_MAX_ITER, STOP_SMALL_STEP, STOP_NON_FINITE
+import dataset
+from common import worker_data, init_worker
+
+# Границы поиска для k0_1, en1, k0_2, en2 и признак логарифмической шкалы по каждому параметру:
+# пред экспоненциальные факторы различаются на порядки, поэтому по ним поиск идет по десятичному логарифму
+DEFAULT_BOUNDS = ((1e-2, 1e8), (0, 20000), (1e-2, 1e8), (0, 20000))
+DEFAULT_LOG_SCALE = (True, False, True, False)
+
+
+def _evaluate_chunk(parameters):
+    return worker_data["batch_loss_function"](parameters, worker_data["x"], worker_data["y"])
+
+
+def to_parameters(u, bounds, log_scale=None):
+    """
+    Переход из единичного куба, в котором работают оптимизаторы, к параметрам модели
+    :param u: матрица точек размера (P, n) с координатами от 0 до 1
+    :param bounds: нижняя и верхняя граница для каждого параметра
+    :param log_scale: признак логарифмической шкалы для каждого параметра (не обязательно)
+    :return: матрица параметров размера (P, n)
+    """
+    low, high = np.asarray(bounds, dtype=float).T.copy()
+    log_scale = np.zeros(len(low), dtype=bool) if log_scale is None else np.asarray(log_scale, dtype=bool)
+    low[log_scale], high[log_scale] = np.log10(low[log_scale]), np.log10(high[log_scale])
+    values = low + np.asarray(u, dtype=float) * (high - low)
+    values[..., log_scale] = 10.0 ** values[..., log_scale]
+    return values
+
+
+class _Evaluator:
+    """
+    Оценка поколения одним пакетным вызовом функции потерь, при n_workers > 1 - частями в пуле процессов
+    """
+
+    def __init__(self, batch_loss_function, x, y, bounds, log_scale, n_workers):
+        self.batch_loss_function = batch_loss_function
+        self.x = x
+        self.y = y
+        self.bounds = bounds
+        self.log_scale = log_scale
+        self.n_workers = os.cpu_count() if n_workers is None else n_workers
+        self.executor = None
+        self.n_evaluations = 0
+        self.best_u = None
+        self.best_loss = np.inf
+
+    def __enter__(self):
+        if self.n_workers > 1:
+            self.x, self.y = dataset.as_arrays(self.x, self.y)
+            self.executor = ProcessPoolExecutor(self.n_workers, initializer=init_worker, initargs=({"batch_loss_function": self.batch_loss_function, "x": self.x, "y": self.y},))
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.executor is not None: self.executor.shutdown()
+
+    def __call__(self, u):
+        parameters = to_parameters(u, self.bounds, self.log_scale)
+        with np.errstate(all="ignore"):
+            if self.executor is None:
+                loss = self.batch_loss_function(parameters, self.x, self.y)
+            else:
+                chunks = np.array_split(parameters, min(self.n_workers, len(parameters)))
+                loss = np.concatenate(list(self.executor.map(_evaluate_chunk, chunks)))
+        loss = np.where(np.isfinite(loss), loss, np.inf)
+        self.n_evaluations += len(u)
+        i = np.argmin(loss)
+        if loss[i] < self.best_loss:
+            self.best_loss = loss[i]
+            self.best_u = u[i].copy()
+        return loss
+
+
+def _result(method, evaluator, n_generations, stop_reason, history, info):
+    iterations, loss_history = (list(range(1, n_generations + 1)), history) if history is not None else (None, None)
+    if evaluator.best_u is None:
+        # Ни одна точка не дала конечной функции потерь
+        parameters, stop_reason = np.full(len(evaluator.bounds), np.nan), STOP_NON_FINITE
+    else:
+        parameters = to_parameters(evaluator.best_u[np.newaxis], evaluator.bounds, evaluator.log_scale)[0]
+    return OptimizationResult(method, parameters, evaluator.best_loss, n_generations, stop_reason, evaluator.n_evaluations, 0,
+                              iterations, loss_history, info=info)
+
+
+def differential_evolution(batch_loss_function, x, y, bounds=DEFAULT_BOUNDS, log_scale=DEFAULT_LOG_SCALE, max_evaluations=10000, population_size=None,
+                           mutation=0.7, crossover=0.9, epsilon=1e-6, seed=0, n_workers=1, suppress_stdout=False, history=False):
+    """
+    Дифференциальная эволюция (схема rand/1/bin) в заданных границах параметров. Каждое поколение оценивается
+    одним пакетным вызовом функции потерь
+    :param batch_loss_function: функция потерь, принимающая матрицу параметров (P, n) и возвращающая P значений
+    :param x: матрица входных данных
+    :param y: вектор экспериментальных данных
+    :param bounds: нижняя и верхняя граница для каждого параметра
+    :param log_scale: признак логарифмической шкалы для каждого параметра
+    :param max_evaluations: бюджет - максимальное количество вычислений функции потерь (не меньше размера популяции)
+    :param population_size: размер популяции (по умолчанию 15 * количество параметров)
+    :param mutation: коэффициент мутации F
+    :param crossover: вероятность скрещивания CR
+    :param epsilon: остановка, когда разброс популяции по каждой координате единичного куба <= epsilon
+    :param seed: значения для инициализации генератора случайных чисел
+    :param n_workers: количество процессов для оценки поколения (1 - без пула, None - по числу ядер)
+    :param suppress_stdout: не выводить сообщения и индикатор прогресса
+    :param history: сохранять лучшую функцию потерь в каждом поколении
+    :return: SGD.OptimizationResult с лучшей найденной точкой (n_loss - количество вычислений функции потерь)
+    """
+    n = len(bounds)
+    if population_size is None: population_size = 15 * n
+    if max_evaluations < population_size:
+        raise ValueError(f"Бюджет max_evaluations={max_evaluations} меньше размера популяции {population_size}")
+    rng = np.random.default_rng(seed)
+    best_history = [] if history else None
+    stop_reason = STOP_MAX_ITER
+    n_generations = 0
+    if not suppress_stdout:
+        print("Расчет оптимальных параметров методом дифференциальной эволюции")
+        pb = ProgressBar(total=max_evaluations, prefix='Progress', suffix='Complete', length=50)
+    with _Evaluator(batch_loss_function, x, y, bounds, log_scale, n_workers) as evaluate:
+        population = rng.random((population_size, n))
+        loss = evaluate(population)
+        index = np.arange(population_size)
+        while evaluate.n_evaluations + population_size <= max_evaluations:
+            # Три различные особи, отличные от текущей
+            others = np.array([rng.choice(population_size - 1, 3, replace=False) for _ in index])
+            others += others >= index[:, np.newaxis]
+            mutant = np.clip(population[others[:, 0]] + mutation * (population[others[:, 1]] - population[others[:, 2]]), 0, 1)
+            cross = rng.random((population_size, n)) < crossover
+            # Хотя бы одна координата берется у мутанта
+            cross[index, rng.integers(0, n, population_size)] = True
+            trial = np.where(cross, mutant, population)
+            trial_loss = evaluate(trial)
+            better = trial_loss <= loss
+            population[better] = trial[better]
+            loss[better] = trial_loss[better]
+            n_generations += 1
+            if history: best_history.append(float(evaluate.best_loss))
+            if not suppress_stdout: pb.print_progress_bar(evaluate.n_evaluations)
+            if np.all(np.ptp(population, axis=0) <= epsilon):
+                stop_reason = STOP_SMALL_STEP
+                break
+        if not suppress_stdout:
+            pb.print_progress_bar(max_evaluations)
+            print(f"Поколений: {n_generations}, вычислений функции потерь: {evaluate.n_evaluations}")
+        return _result("differential_evolution", evaluate, n_generations, stop_reason, best_history, {"population": to_parameters(population, bounds, log_scale), "population_loss": loss})
+
+
+def cma_es(batch_loss_function, x, y, bounds=DEFAULT_BOUNDS, log_scale=DEFAULT_LOG_SCALE, max_evaluations=10000, population_size=None,
+           sigma=0.3, epsilon=1e-8, seed=0, n_workers=1, suppress_stdout=False, history=False):
+    """
+    Эволюционная стратегия с адаптацией ковариационной матрицы (CMA-ES) в заданных границах параметров.
+    Поиск идет в единичном кубе, точки за границами куба возвращаются на границу. Каждое поколение оценивается
+    одним пакетным вызовом функции потерь
+    :param batch_loss_function: функция потерь, принимающая матрицу параметров (P, n) и возвращающая P значений
+    :param x: матрица входных данных
+    :param y: вектор экспериментальных данных
+    :param bounds: нижняя и верхняя граница для каждого параметра
+    :param log_scale: признак логарифмической шкалы для каждого параметра
+    :param max_evaluations: бюджет - максимальное количество вычислений функции потерь (не меньше количества точек в поколении)
+    :param population_size: количество точек в поколении (по умолчанию 4 + 3*ln(количество параметров))
+    :param sigma: начальный шаг в единичном кубе
+    :param epsilon: остановка, когда шаг по каждой главной оси <= epsilon
+    :param seed: значения для инициализации генератора случайных чисел
+    :param n_workers: количество процессов для оценки поколения (1 - без пула, None - по числу ядер)
+    :param suppress_stdout: не выводить сообщения и индикатор прогресса
+    :param history: сохранять лучшую функцию потерь в каждом поколении
+    :return: SGD.OptimizationResult с лучшей найденной точкой (n_loss - количество вычислений функции потерь)
+    """
+    n = len(bounds)
+    lam = 4 + int(3 * np.log(n)) if population_size is None else population_size
+    if max_evaluations < lam:
+        raise ValueError(f"Бюджет max_evaluations={max_evaluations} меньше количества точек в поколении {lam}")
+    mu = lam // 2
+    # Веса лучших mu точек и параметры адаптации (рекомендуемые значения)
+    weights = np.log(mu + 0.5) - np.log(np.arange(1, mu + 1))
+    weights /= weights.sum()
+    mueff = 1 / np.sum(weights ** 2)
+    cc = (4 + mueff / n) / (n + 4 + 2 * mueff / n)
+    cs = (mueff + 2) / (n + mueff + 5)
+    c1 = 2 / ((n + 1.3) ** 2 + mueff)
+    cmu = min(1 - c1, 2 * (mueff - 2 + 1 / mueff) / ((n + 2) ** 2 + mueff))
+    damps = 1 + 2 * max(0, np.sqrt((mueff - 1) / (n + 1)) - 1) + cs
+    chi_n = np.sqrt(n) * (1 - 1 / (4 * n) + 1 / (21 * n ** 2))
+
+    rng = np.random.default_rng(seed)
+    mean = np.full(n, 0.5)
+    pc = np.zeros(n)
+    ps = np.zeros(n)
+    B = np.eye(n)
+    D = np.ones(n)
+    C = np.eye(n)
+    best_history = [] if history else None
+    stop_reason = STOP_MAX_ITER
+    n_generations = 0
+    if not suppress_stdout:
+        print("Расчет оптимальных параметров методом CMA-ES")
+        pb = ProgressBar(total=max_evaluations, prefix='Progress', suffix='Complete', length=50)
+    with _Evaluator(batch_loss_function, x, y, bounds, log_scale, n_workers) as evaluate:
+        while evaluate.n_evaluations + lam <= max_evaluations:
+            steps = rng.standard_normal((lam, n)) @ (B * D).T
+            points = np.clip(mean + sigma * steps, 0, 1)
+            # В обновлении используются исправленные (возвращенные в куб) точки
+            steps = (points - mean) / sigma
+            loss = evaluate(points)
+            selected = steps[np.argsort(loss, kind="stable")[:mu]]
+            step_w = weights @ selected
+            mean = mean + sigma * step_w
+            ps = (1 - cs) * ps + np.sqrt(cs * (2 - cs) * mueff) * (B @ ((B.T @ step_w) / D))
+            n_generations += 1
+            hsig = np.linalg.norm(ps) / np.sqrt(1 - (1 - cs) ** (2 * n_generations)) / chi_n < 1.4 + 2 / (n + 1)
+            pc = (1 - cc) * pc + hsig * np.sqrt(cc * (2 - cc) * mueff) * step_w
+            C = ((1 - c1 - cmu) * C + c1 * (np.outer(pc, pc) + (1 - hsig) * cc * (2 - cc) * C)
+                 + cmu * (selected.T * weights) @ selected)
+            sigma *= np.exp(cs / damps * (np.linalg.norm(ps) / chi_n - 1))
+            C = (C + C.T) / 2
+            D2, B = np.linalg.eigh(C)
+            D = np.sqrt(np.maximum(D2, 1e-20))
+            if history: best_history.append(float(evaluate.best_loss))
+            if not suppress_stdout: pb.print_progress_bar(evaluate.n_evaluations)
+            if sigma * np.max(D) <= epsilon:
+                stop_reason = STOP_SMALL_STEP
+                break
+        if not suppress_stdout:
+            pb.print_progress_bar(max_evaluations)
+            print(f"Поколений: {n_generations}, вычислений функции потерь: {evaluate.n_evaluations}")
+        return _result("cma_es", evaluate, n_generations, stop_reason, best_history,
+                       {"mean": to_parameters(mean[np.newaxis], bounds, log_scale)[0], "sigma": sigma})
@@ -1,14 +1,342 @@
 import math
+import numpy as np
+import profiling
 
 R = 1.987
+# Наибольший логарифм константы скорости: exp(700) ~ 1e304 еще представимо в float64. При больших
+# отрицательных энергиях активации константа ограничивается этим значением, а не переполняется
+MAX_LOG_K = 700.0
+
+
+def as_float(a):
+    """
+    Приведение к массиву с плавающей точкой без лишнего копирования: массивы float32 и float64 (например, столбцы
+    dataset.Dataset) возвращаются как есть, списки и целочисленные массивы преобразуются в float64
+    :param a: число, список или массив
+    :returns: массив numpy с плавающей точкой
+    """
+    a = np.asarray(a)
+    return a if np.issubdtype(a.dtype, np.floating) else a.astype(float)
 
 
 def find_k(k0, en, temp):
     """
-    Расчет константы скорости реакции
+    Расчет константы скорости реакции. Логарифм |k| = ln|k0| - en/(R*T) ограничивается MAX_LOG_K,
+    поэтому при любых параметрах результат конечен
     :param k0: пред экспоненциальный фактор
     :param en: энергия активации
     :param temp: температура
     :returns: константа скорости реакции для заданных значений
     """
-    return k0 * math.exp(-en / (R * temp))
\ No newline at end of file
+    if k0 == 0: return 0.0
+    return math.copysign(math.exp(min(math.log(abs(k0)) - en / (R * temp), MAX_LOG_K)), k0)
+
+
+def find_k_array(k0, en, temp):
+    """
+    Расчет константы скорости реакции для массивов (поэлементно, с учетом правил broadcasting numpy),
+    логарифм константы ограничивается так же, как в find_k
+    :param k0: пред экспоненциальный фактор
+    :param en: энергия активации
+    :param temp: температура
+    :returns: массив констант скорости реакции
+    """
+    with np.errstate(divide="ignore"):
+        # R*T всегда в float64, даже если температуры хранятся в float32
+        log_k = np.log(np.abs(k0)) - en / np.multiply(R, temp, dtype=float)
+    return np.sign(k0) * np.exp(np.minimum(log_k, MAX_LOG_K))
+
+
+def nonfinite_to_inf(loss):
+    """
+    Замена nan и бесконечностей в значениях функции потерь на +inf: параметры, при которых решение ДУ
+    переполнилось, считаются бесконечно плохими, и оптимизаторы отбрасывают такие шаги
+    :param loss: значение или массив значений функции потерь
+    :returns: значение или массив, в котором все нечисловые и бесконечные значения равны +inf
+    """
+    if np.ndim(loss) == 0: return loss if np.isfinite(loss) else np.inf
+    return np.where(np.isfinite(loss), loss, np.inf)
+
+
+def analytic_g(k1, k2, g0, time):
+    """
+    Точное решение ДУ dG/dt = k2*(g0 - G) - k1*G:
+    G(t) = g0*(k2 + k1*exp(-(k1+k2)*t))/(k1+k2) = g0*(1 - k1*t*(1 - exp(-z))/z), z = (k1+k2)*t
+    :param k1: константа скорости реакции глюкозы
+    :param k2: константа скорости реакции фруктозы
+    :param g0: начальная концентрация глюкозы при t = 0
+    :param time: момент времени t
+    :returns: концентрацию глюкозы в момент времени t (+inf, если решение переполнилось)
+    """
+    z = (k1 + k2) * time
+    # (1 - exp(-z))/z через expm1, чтобы не терять точность при k1 + k2 -> 0 (предел равен 1).
+    # При большом отрицательном z экспонента переполняется, и результат равен +inf, а не исключению
+    with np.errstate(over="ignore", invalid="ignore"):
+        phi = 1.0 if z == 0 else -np.expm1(-z) / z
+        return nonfinite_to_inf(float(g0 * (1 - k1 * time * phi)))
+
+
+def analytic_g_array(k1, k2, g0, time):
+    """
+    Точное решение ДУ (см. analytic_g) сразу для массивов аргументов
+    :param k1: константа скорости реакции глюкозы
+    :param k2: константа скорости реакции фруктозы
+    :param g0: начальная концентрация глюкозы при t = 0
+    :param time: момент времени t
+    :returns: массив концентраций глюкозы
+    """
+    z = (k1 + k2) * time
+    with np.errstate(divide="ignore", invalid="ignore"):
+        phi = np.where(z == 0, 1.0, -np.expm1(-z) / z)
+    return g0 * (1 - k1 * time * phi)
+
+
+def rk4_g_array(k1, k2, g0, time, h):
+    """
+    Метод Рунге-Кутты четвертого порядка сразу для массива образцов.
+    Все образцы интегрируются синхронно с общим шагом h, образец перестает обновляться, как только
+    пройдено его время - количество шагов для каждого образца то же, что и в цикле while t_i < time
+    :param k1: константа скорости реакции глюкозы
+    :param k2: константа скорости реакции фруктозы
+    :param g0: начальная концентрация глюкозы при t = 0
+    :param time: момент времени t
+    :param h: шаг метода Рунге-Кутты
+    :returns: массив концентраций глюкозы
+    """
+    shape = np.broadcast_shapes(np.shape(k1), np.shape(k2), np.shape(g0), np.shape(time))
+    G_i = np.array(np.broadcast_to(g0, shape), dtype=float)
+    if G_i.size == 0: return G_i
+    # Функция расчета производной концентрации глюкозы по времени
+    def f(g): return k2 * (g0 - g) - k1 * g
+    # Сравнение t_i < time должно идти в float64, даже если время хранится в float32
+    time = np.asarray(time, dtype=float)
+    t_i = 0
+    t_max = np.max(time)
+    # Количество шагов, сделанных каждым образцом (при broadcasting каждый момент времени повторяется одинаково)
+    n_steps = 0
+    while t_i < t_max:
+        # образцы, время которых еще не достигнуто
+        active = t_i < time
+        n_steps += np.count_nonzero(active)
+        t_i += h
+        K1 = f(G_i)
+        K2 = f(G_i + h/2*K1)
+        K3 = f(G_i + h/2*K2)
+        K4 = f(G_i + h*K3)
+        G_i = np.where(active, G_i + h/6*(K1+2*K2+2*K3+K4), G_i)
+    profiling.count("rk4_steps", int(n_steps) * (G_i.size // time.size))
+    return G_i
+
+
+def analytic_g_sensitivity_array(k1, k2, g0, time):
+    """
+    Точное решение ДУ и его производные по константам скорости:
+    G = g0*(1 - k1*t*phi(z)), dG/dk1 = g0*(-t*phi(z) + k1*t^2*psi(z)), dG/dk2 = g0*k1*t^2*psi(z),
+    где z = (k1+k2)*t, phi(z) = (1 - exp(-z))/z, psi(z) = (1 - exp(-z) - z*exp(-z))/z^2
+    :param k1: константа скорости реакции глюкозы
+    :param k2: константа скорости реакции фруктозы
+    :param g0: начальная концентрация глюкозы при t = 0
+    :param time: момент времени t
+    :returns: массивы G, dG/dk1, dG/dk2
+    """
+    # Произведения g0 и time между собой не должны считаться в float32
+    g0, time = np.asarray(g0, dtype=float), np.asarray(time, dtype=float)
+    z = (k1 + k2) * time
+    small = np.abs(z) < 1e-4
+    with np.errstate(divide="ignore", invalid="ignore"):
+        phi = np.where(z == 0, 1.0, -np.expm1(-z) / z)
+        # при малых z разность в числителе psi теряет точность, поэтому используется ряд Тейлора
+        psi = np.where(small, 0.5 - z/3 + z**2/8 - z**3/30, (-np.expm1(-z) - z*np.exp(-z)) / z**2)
+    G = g0 * (1 - k1 * time * phi)
+    dG_dk2 = g0 * k1 * time**2 * psi
+    dG_dk1 = -g0 * time * phi + dG_dk2
+    return G, dG_dk1, dG_dk2
+
+
+def rk4_g_sensitivity_array(k1, k2, g0, time, h):
+    """
+    Метод Рунге-Кутты четвертого порядка (см. rk4_g_array) для концентрации глюкозы вместе с
+    уравнениями чувствительности S1 = dG/dk1 и S2 = dG/dk2:
+    dS1/dt = -(k1+k2)*S1 - G, dS2/dt = -(k1+k2)*S2 + (g0 - G), S1(0) = S2(0) = 0.
+    Так как метод Рунге-Кутты линеен по состоянию, S1 и S2 - точные производные разностного решения
+    :param k1: константа скорости реакции глюкозы
+    :param k2: константа скорости реакции фруктозы
+    :param g0: начальная концентрация глюкозы при t = 0
+    :param time: момент времени t
+    :param h: шаг метода Рунге-Кутты
+    :returns: массивы G, dG/dk1, dG/dk2
+    """
+    shape = np.broadcast_shapes(np.shape(k1), np.shape(k2), np.shape(g0), np.shape(time))
+    G_i = np.array(np.broadcast_to(g0, shape), dtype=float)
+    S1_i = np.zeros(shape)
+    S2_i = np.zeros(shape)
+    if G_i.size == 0: return G_i, S1_i, S2_i
+    s = k1 + k2
+    # Функция расчета производных концентрации глюкозы и чувствительностей по времени
+    def f(g, s1, s2): return k2 * (g0 - g) - k1 * g, -s * s1 - g, -s * s2 + (g0 - g)
+    # Сравнение t_i < time должно идти в float64, даже если время хранится в float32
+    time = np.asarray(time, dtype=float)
+    t_i = 0
+    t_max = np.max(time)
+    n_steps = 0
+    while t_i < t_max:
+        active = t_i < time
+        n_steps += np.count_nonzero(active)
+        t_i += h
+        K1 = f(G_i, S1_i, S2_i)
+        K2 = f(*(v + h/2*k for v, k in zip((G_i, S1_i, S2_i), K1)))
+        K3 = f(*(v + h/2*k for v, k in zip((G_i, S1_i, S2_i), K2)))
+        K4 = f(*(v + h*k for v, k in zip((G_i, S1_i, S2_i), K3)))
+        G_i, S1_i, S2_i = (np.where(active, v + h/6*(a+2*b+2*c+d), v)
+                           for v, a, b, c, d in zip((G_i, S1_i, S2_i), K1, K2, K3, K4))
+    profiling.count("rk4_steps", int(n_steps) * (G_i.size // time.size))
+    return G_i, S1_i, S2_i
+
+
+def group_samples(*columns):
+    """
+    Группировка образцов по начальным условиям (например, по g0 и температуре)
+    :param columns: векторы значений начальных условий для каждого образца
+    :returns: матрицу уникальных начальных условий размера (n_groups, len(columns)) и номер группы для каждого образца
+    """
+    keys, group = np.unique(np.stack(columns, axis=-1), axis=0, return_inverse=True)
+    return keys, group.ravel()
+
+
+def grouped_rk4_g_array(k1, k2, g0, time, group, h):
+    """
+    Метод Рунге-Кутты четвертого порядка, в котором каждая траектория (группа образцов с общими начальными условиями)
+    интегрируется один раз до наибольшего времени ее образцов, а не заново от t = 0 для каждого образца.
+    Значение для образца берется на том шаге, на котором остановился бы цикл while t_i < time в find_g,
+    поэтому результат совпадает с rk4_g_array. Траектории интегрируются синхронно (см. kernels.grouped_rk4_g)
+    :param k1: константы скорости реакции глюкозы для каждой группы (..., n_groups)
+    :param k2: константы скорости реакции фруктозы для каждой группы (..., n_groups)
+    :param g0: начальные концентрации глюкозы для каждой группы (n_groups)
+    :param time: вектор моментов времени образцов (N)
+    :param group: номер группы для каждого образца (N)
+    :param h: шаг метода Рунге-Кутты
+    :returns: массив концентраций глюкозы формы (..., N)
+    """
+    shape = np.broadcast_shapes(np.shape(k1), np.shape(k2), np.shape(g0))
+    time = np.asarray(time, dtype=float)
+    G = np.empty(shape[:-1] + time.shape)
+    if time.size == 0: return G
+    # Моменты t_i с тем же накоплением, что и в цикле find_g: номер шага образца - количество t_i < time
+    t = [0.0]
+    t_max = np.max(time)
+    while t[-1] < t_max: t.append(t[-1] + h)
+    step = np.searchsorted(t, time)
+    n_steps = int(step.max())
+    # Образцы по номеру шага, на котором читается их значение
+    sample_order = np.argsort(step, kind="stable")
+    bounds = np.searchsorted(step[sample_order], np.arange(n_steps + 2))
+    # Функция расчета производной концентрации глюкозы по времени
+    def f(g): return k2 * (g0 - g) - k1 * g
+    G_i = np.array(np.broadcast_to(g0, shape), dtype=float)
+    for n in range(n_steps + 1):
+        samples = sample_order[bounds[n]:bounds[n + 1]]
+        G[..., samples] = G_i[..., group[samples]]
+        if n == n_steps: break
+        K1 = f(G_i)
+        K2 = f(G_i + h/2*K1)
+        K3 = f(G_i + h/2*K2)
+        K4 = f(G_i + h*K3)
+        G_i = G_i + h/6*(K1+2*K2+2*K3+K4)
+    # Шаги каждой траектории до наибольшего времени ее образцов (как в компилированном ядре)
+    group_steps = np.zeros(shape[-1], dtype=int)
+    np.maximum.at(group_steps, group, step)
+    profiling.count("rk4_steps", int(group_steps.sum()) * (G_i.size // shape[-1]))
+    return G
+
+
+# Коэффициенты вложенного метода Дормана-Принса 5(4)
+DOPRI5_A = ((1/5,),
+            (3/40, 9/40),
+            (44/45, -56/15, 32/9),
+            (19372/6561, -25360/2187, 64448/6561, -212/729),
+            (9017/3168, -355/33, 46732/5247, 49/176, -5103/18656),
+            (35/384, 0, 500/1113, 125/192, -2187/6784, 11/84))
+# Разность весов решений 5-го и 4-го порядков, дает оценку локальной погрешности
+DOPRI5_E = (71/57600, 0, -71/16695, 71/1920, -17253/339200, 22/525, -1/40)
+
+
+def dopri5_g(k1, k2, g0, times, rtol=1e-6, atol=1e-9, max_steps=100000):
+    """
+    Метод Дормана-Принса 5(4) с адаптивным шагом для одной траектории. Шаг выбирается так, чтобы оценка
+    локальной погрешности не превышала atol + rtol*|G|, и укорачивается, чтобы попасть точно в каждый момент времени
+    :param k1: константа скорости реакции глюкозы
+    :param k2: константа скорости реакции фруктозы
+    :param g0: начальная концентрация глюкозы при t = 0
+    :param times: моменты времени, в которые нужна концентрация (в любом порядке)
+    :param rtol: допустимая относительная погрешность
+    :param atol: допустимая абсолютная погрешность
+    :param max_steps: максимальное количество шагов (при превышении оставшиеся значения равны nan)
+    :returns: массив концентраций глюкозы в моменты времени times и словарь с количеством принятых (n_accepted)
+    и отброшенных (n_rejected) шагов, вычислений правой части (n_f) и признаком успешного завершения (success)
+    """
+    # Функция расчета производной концентрации глюкозы по времени
+    def f(g): return k2 * (g0 - g) - k1 * g
+    times = np.asarray(times, dtype=float)
+    result = np.full(times.shape, np.nan)
+    stats = {"n_accepted": 0, "n_rejected": 0, "n_f": 1, "success": True}
+    t_i = 0.0
+    G_i = float(g0)
+    K = [f(G_i)]
+    # Начальный шаг по масштабу решения и производной
+    scale = atol + rtol * abs(G_i)
+    h = 0.01 * abs(G_i) / abs(K[0]) if abs(G_i) > 1e-5 * scale and abs(K[0]) > 1e-5 * scale else 1e-6
+    for i in np.argsort(times):
+        t_out = times[i]
+        while t_i < t_out:
+            if stats["n_accepted"] + stats["n_rejected"] >= max_steps:
+                stats["success"] = False
+                profiling.count("dopri5_steps", stats["n_accepted"] + stats["n_rejected"])
+                return result, stats
+            h_step = min(h, t_out - t_i)
+            K = K[:1]
+            for a in DOPRI5_A:
+                K.append(f(G_i + h_step * sum(a_j * K_j for a_j, K_j in zip(a, K))))
+            stats["n_f"] += 6
+            # Решение 5-го порядка (последняя стадия вычисляется в новой точке, поэтому совпадает с f(G_new))
+            G_new = G_i + h_step * sum(a_j * K_j for a_j, K_j in zip(DOPRI5_A[-1], K))
+            error = abs(h_step * sum(e_j * K_j for e_j, K_j in zip(DOPRI5_E, K))) / (atol + rtol * max(abs(G_i), abs(G_new)))
+            if error <= 1:
+                t_i = t_out if h_step == t_out - t_i else t_i + h_step
+                G_i = G_new
+                K = K[-1:]
+                stats["n_accepted"] += 1
+            else:
+                stats["n_rejected"] += 1
+                K = K[:1]
+            if math.isfinite(error):
+                h = h_step * min(5.0, max(0.2, 0.9 * (error if error > 0 else 1e-10) ** -0.2))
+            else:
+                h = h_step * 0.2
+        result[i] = G_i
+    profiling.count("dopri5_steps", stats["n_accepted"] + stats["n_rejected"])
+    return result, stats
+
+
+def grouped_dopri5_g(k1, k2, g0, time, group, rtol=1e-6, atol=1e-9):
+    """
+    Метод Дормана-Принса 5(4) (см. dopri5_g) по одному интегрированию на траекторию (группу образцов)
+    :param k1: константы скорости реакции глюкозы для каждой группы (..., n_groups)
+    :param k2: константы скорости реакции фруктозы для каждой группы (..., n_groups)
+    :param g0: начальные концентрации глюкозы для каждой группы (n_groups)
+    :param time: вектор моментов времени образцов (N)
+    :param group: номер группы для каждого образца (N)
+    :param rtol: допустимая относительная погрешность
+    :param atol: допустимая абсолютная погрешность
+    :returns: массив концентраций глюкозы формы (..., N) и суммарная статистика шагов (см. dopri5_g)
+    """
+    shape = np.broadcast_shapes(np.shape(k1), np.shape(k2), np.shape(g0))
+    k1, k2, g0 = (np.broadcast_to(v, shape) for v in (k1, k2, g0))
+    time = as_float(time)
+    G = np.empty(shape[:-1] + time.shape)
+    total = {"n_accepted": 0, "n_rejected": 0, "n_f": 0, "success": True}
+    for index in np.ndindex(*shape):
+        mask = group == index[-1]
+        G[index[:-1]][..., mask], stats = dopri5_g(k1[index], k2[index], g0[index], time[mask], rtol, atol)
+        for key in ("n_accepted", "n_rejected", "n_f"): total[key] += stats[key]
+        total["success"] = total["success"] and stats["success"]
+    return G, total
@@ -1,53 +1,258 @@
 import numpy as np
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from console_progressbar import ProgressBar
 from SGD import minibatch_stochastic_gradient_descent_lf
-from optimization_4_param import generate_data, loss_function
-import warnings
-
-def global_optimization(start, end, num_of_points):
-    e1 = np.linspace(start, end, num_of_points)
-    e2 = np.linspace(start, end, num_of_points)
-    k0_1 = np.linspace(start, end, num_of_points)
-    k0_2 = np.linspace(start, end, num_of_points)
+import dataset
+from common import worker_data, init_worker, save_npz
+from optimization_4_param import generate_data, loss_function, batch_loss_function
+from evolutionary_optimization import DEFAULT_BOUNDS, DEFAULT_LOG_SCALE, differential_evolution, cma_es
+from two_step_optimization import two_step_optimization
+
+def make_grid(start, end, num_of_points):
+    """
+    Равномерная сетка начальных точек
+    :param start: нижняя граница по каждому параметру
+    :param end: верхняя граница по каждому параметру
+    :param num_of_points: количество точек по каждому параметру
+    :return: матрица размера (num_of_points**4, 4), каждая строчка содержит k0_1, en1, k0_2, en2
+    """
+    axis = np.linspace(start, end, num_of_points)
+    grid = np.meshgrid(axis, axis, axis, axis, indexing="ij")
+    return np.stack(grid, axis=-1).reshape(-1, 4)
+
+def run_start(initial_parameters, x, y, alpha, n_iter, n_iter_no_change, batch_size):
+    """
+    Спуск из одной начальной точки
+    :param initial_parameters: начальные значения параметров
+    :param x: матрица входных данных
+    :param y: вектор экспериментальных данных
+    :param alpha: скорость спуска
+    :param n_iter: количество итераций
+    :param n_iter_no_change: максимальное количество итераций без уменьшения функции потерь
+    :param batch_size: размер одного пакета
+    :return: найденные параметры и функция потерь по всем данным (None и inf, если спуск не нашел точку с конечной
+    функцией потерь из-за переполнения)
+    """
+    # Переполнение не прерывает спуск: функция потерь равна +inf, и спуск отступает с меньшим шагом (см. SGD.py)
+    result = minibatch_stochastic_gradient_descent_lf(loss_function, initial_parameters, alpha, n_iter, x, y, batch_size, max_n_iter_no_change=n_iter_no_change, suppress_stdout=True, return_result=True)
+    return (result.parameters, float(result.loss)) if np.isfinite(result.loss) else (None, np.inf)
+
+def _run_chunk(chunk):
+    x, y = worker_data["x"], worker_data["y"]
+    return [run_start(initial_parameters, x, y, **worker_data["descent_parameters"]) for initial_parameters in chunk]
+
+def save_checkpoint(path, starts, index, parameters, loss, failed):
+    """
+    Сохранение завершенных стартов в файл .npz. Файл сначала пишется во временный, а затем заменяет старый,
+    чтобы прерывание во время записи не испортило контрольную точку
+    :param path: путь к файлу контрольной точки
+    :param starts: матрица всех начальных точек (для проверки при возобновлении)
+    :param index: индексы завершенных стартов
+    :param parameters: найденные параметры для завершенных стартов
+    :param loss: функция потерь для завершенных стартов (inf для прерванных)
+    :param failed: признак прерванного из-за переполнения спуска
+    """
+    save_npz(path, starts=starts, index=index, parameters=parameters, loss=loss, failed=failed)
+
+def load_checkpoint(path):
+    """
+    Загрузка контрольной точки, сохраненной save_checkpoint
+    :param path: путь к файлу контрольной точки
+    :return: словарь с массивами starts, index, parameters, loss, failed
+    """
+    with np.load(path) as data:
+        return {key: data[key] for key in data.files}
+
+def run_starts(starts, x, y, alpha, n_iter, n_iter_no_change, batch_size, n_workers=1, chunk_size=None, pb=None, checkpoint=None, checkpoint_every=100, resume=False):
+    """
+    Спуск из каждой начальной точки, последовательно или в пуле процессов
+    :param starts: матрица начальных точек размера (P, 4)
+    :param x: матрица входных данных
+    :param y: вектор экспериментальных данных
+    :param alpha: скорость спуска
+    :param n_iter: количество итераций
+    :param n_iter_no_change: максимальное количество итераций без уменьшения функции потерь
+    :param batch_size: размер одного пакета
+    :param n_workers: количество процессов (1 - без пула, None - по числу ядер)
+    :param chunk_size: количество начальных точек в одной задаче для процесса (не обязательно)
+    :param pb: индикатор прогресса (не обязательно)
+    :param checkpoint: путь к файлу .npz для сохранения завершенных стартов (не обязательно)
+    :param checkpoint_every: через сколько завершенных стартов сохранять контрольную точку
+    :param resume: пропустить старты, уже сохраненные в контрольной точке
+    :return: список из P пар (найденные параметры, функция потерь), (None, inf) для прерванных спусков
+    """
+    descent_parameters = dict(alpha=alpha, n_iter=n_iter, n_iter_no_change=n_iter_no_change, batch_size=batch_size)
+    if n_workers is None: n_workers = os.cpu_count()
+    starts = np.asarray(starts, dtype=float)
+    results = [(None, np.inf)] * len(starts)
+    done = np.zeros(len(starts), dtype=bool)
+    if checkpoint is not None and resume and os.path.exists(checkpoint):
+        saved = load_checkpoint(checkpoint)
+        if not np.array_equal(saved["starts"], starts):
+            raise ValueError(f"Контрольная точка {checkpoint} сохранена для другой сетки начальных точек")
+        for i, parameters, loss, failed in zip(saved["index"], saved["parameters"], saved["loss"], saved["failed"]):
+            results[i] = (None, np.inf) if failed else (parameters, float(loss))
+        done[saved["index"]] = True
+    count = int(done.sum())
+    last_saved = count
+
+    def save():
+        index = np.flatnonzero(done)
+        failed = np.array([results[i][0] is None for i in index], dtype=bool)
+        parameters = np.array([np.full(4, np.nan) if results[i][0] is None else results[i][0] for i in index]).reshape(-1, 4)
+        # Потери уже посчитаны в конце каждого спуска и не пересчитываются
+        loss = np.array([results[i][1] for i in index], dtype=float)
+        save_checkpoint(checkpoint, starts, index, parameters, loss, failed)
+
+    def finish(i, result):
+        nonlocal count, last_saved
+        results[i] = result
+        done[i] = True
+        if pb is not None: pb.print_progress_bar(count)
+        count += 1
+        if checkpoint is not None and count - last_saved >= checkpoint_every:
+            save()
+            last_saved = count
+
+    pending = np.flatnonzero(~done)
+    try:
+        if n_workers <= 1:
+            for i in pending:
+                finish(i, run_start(starts[i], x, y, **descent_parameters))
+        else:
+            if chunk_size is None: chunk_size = max(1, -(-len(pending) // (4 * n_workers)))
+            x, y = dataset.as_arrays(x, y)
+            with ProcessPoolExecutor(n_workers, initializer=init_worker, initargs=({"x": x, "y": y, "descent_parameters": descent_parameters},)) as executor:
+                futures = {}
+                for j in range(0, len(pending), chunk_size):
+                    chunk_index = pending[j:j + chunk_size]
+                    futures[executor.submit(_run_chunk, starts[chunk_index])] = chunk_index
+                for future in as_completed(futures):
+                    for i, result in zip(futures[future], future.result()):
+                        finish(i, result)
+    finally:
+        # Завершенные старты сохраняются и при прерывании (Ctrl-C, ошибка в процессе-исполнителе)
+        if checkpoint is not None and count > last_saved: save()
+    return results
+
+def rank_results(results):
+    """
+    Отбрасывает прерванные спуски, потери остальных берутся из результатов спусков (без повторного расчета)
+    :param results: список пар (найденные параметры, функция потерь), (None, inf) для прерванных спусков (см. run_starts)
+    :return: матрица параметров и вектор потерь
+    """
+    finished = [(parameters, loss) for parameters, loss in results if parameters is not None]
+    parameters_arr = np.array([parameters for parameters, _ in finished]).reshape(-1, 4)
+    loss_arr = np.array([loss for _, loss in finished], dtype=float)
+    return parameters_arr, loss_arr
+
+def successive_halving(starts, x, y, alpha, batch_size, n_iter_min=1, eta=3, max_n_iter=1000, n_workers=1, suppress_stdout=False):
+    """
+    Последовательное деление (successive halving): все точки получают n_iter_min итераций спуска,
+    затем лучшая 1/eta часть по функции потерь продолжает спуск с количеством итераций, увеличенным в eta раз,
+    и так далее, пока не останется одна точка
+    :param starts: матрица начальных точек размера (P, 4)
+    :param x: матрица входных данных
+    :param y: вектор экспериментальных данных
+    :param alpha: скорость спуска
+    :param batch_size: размер одного пакета
+    :param n_iter_min: количество итераций на первом этапе
+    :param eta: во сколько раз уменьшается количество точек и увеличивается количество итераций на каждом этапе
+    :param max_n_iter: максимальное количество итераций на одном этапе
+    :param n_workers: количество процессов (1 - без пула, None - по числу ядер)
+    :param suppress_stdout: не выводить сообщения и индикатор прогресса
+    :return: лучшие найденные параметры, их потери и суммарное количество итераций спуска
+    """
+    candidates = np.asarray(starts, dtype=float)
+    n_iter = n_iter_min
+    total_iter = 0
+    while True:
+        if suppress_stdout:
+            pb = None
+        else:
+            print(f"Точек: {len(candidates)}, итераций: {n_iter}")
+            pb = ProgressBar(total=max(len(candidates)-1, 1), prefix="Progress", suffix='Complete', length=50)
+        results = run_starts(candidates, x, y, alpha, n_iter, n_iter, batch_size, n_workers=n_workers, pb=pb)
+        total_iter += n_iter * len(candidates)
+        parameters_arr, loss_arr = rank_results(results)
+        order = np.argsort(loss_arr)
+        order = order[np.isfinite(loss_arr[order])]
+        if len(order) == 0: raise RuntimeError("Все спуски прервались из-за переполнения")
+        # Победитель дальше уточняется отдельно, поэтому на одну оставшуюся точку этап не тратится
+        if len(order) // eta <= 1: break
+        candidates = parameters_arr[order[:len(order) // eta]]
+        n_iter = min(n_iter * eta, max_n_iter)
+    return parameters_arr[order[0]], loss_arr[order[0]], total_iter
+
+def global_optimization(start, end, num_of_points, n_workers=1, halving=False, eta=3, checkpoint=None, resume=False, suppress_stdout=False,
+                        method="grid", bounds=DEFAULT_BOUNDS, log_scale=DEFAULT_LOG_SCALE, max_evaluations=10000, seed=0):
+    """
+    Глобальная оптимизация 4-ех параметров: поиск начальной точки (спуск из каждой точки сетки
+    или популяционный метод в границах параметров) и уточнение лучшего результата
+    :param start: нижняя граница сетки по каждому параметру (только для method="grid")
+    :param end: верхняя граница сетки по каждому параметру (только для method="grid")
+    :param num_of_points: количество точек сетки по каждому параметру (только для method="grid")
+    :param n_workers: количество процессов для спусков из точек сетки или оценки поколений (1 - без пула, None - по числу ядер)
+    :param halving: отбирать точки сетки последовательным делением (см. successive_halving) вместо одинакового спуска из всех точек
+    :param eta: коэффициент отбора для последовательного деления
+    :param checkpoint: путь к файлу .npz для периодического сохранения результатов спусков из точек сетки (не обязательно, без последовательного деления)
+    :param resume: продолжить прерванный расчет по контрольной точке, пропуская завершенные точки сетки
+    :param suppress_stdout: не выводить сообщения и индикаторы прогресса
+    :param method: способ поиска начальной точки: "grid" - сетка, "de" - дифференциальная эволюция, "cmaes" - CMA-ES,
+    "two_step" - подбор k1, k2 при каждой температуре и уравнение Аррениуса (самый быстрый, см. two_step_optimization.py)
+    :param bounds: границы каждого параметра для "de" и "cmaes" (см. evolutionary_optimization.py)
+    :param log_scale: признак логарифмической шкалы для каждого параметра для "de" и "cmaes"
+    :param max_evaluations: бюджет вычислений функции потерь для "de" и "cmaes"
+    :param seed: значения для инициализации генератора случайных чисел для "de" и "cmaes"
+    :return: результат уточнения (SGD.OptimizationResult), в info - лучшая точка первого этапа (grid_parameters, grid_loss),
+    для сетки - количество стартов (n_starts) и суммарное количество итераций, выделенных на спуски из точек сетки (grid_n_iter),
+    для популяционных и двухэтапного методов - их результат (global_result)
+    """
     x, y = generate_data(42)
-    loss_arr = []
-    parameters_arr = []
-    pb = ProgressBar(total=num_of_points**4-1,prefix="Progress", suffix='Complete', length=50)
-    count = 0
-    warnings.simplefilter('error', RuntimeWarning)
     alpha = 0.0001
     n_iter = 5
     n_iter_no_change = 5
     batch_size = 20
-    for i in range(num_of_points):
-        for j in range(num_of_points):
-            for k in range(num_of_points):
-                for l in range(num_of_points):
-                    initial_parameters = [k0_1[i], e1[j], k0_2[k], e2[l]]
-                    try:
-                        parameters_mbsgd = minibatch_stochastic_gradient_descent_lf(loss_function, initial_parameters, alpha, n_iter, x, y, batch_size, max_n_iter_no_change=n_iter_no_change, suppress_stdout=True)
-                        loss = loss_function(*parameters_mbsgd, x, y)
-                        loss_arr.append(loss)
-                        parameters_arr.append(parameters_mbsgd)
-                    except RuntimeWarning:
-                        pass
-                    finally:
-                        pb.print_progress_bar(count)
-                        count += 1
-
-    loss_arr = np.array(loss_arr)
-    loss = np.min(loss_arr)
-    i_min = np.argmin(loss_arr)
-    parameters = parameters_arr[i_min]
-    print("минималки")
-    print(parameters)
-    print(loss)
+    info = {}
+    if method in ("de", "cmaes"):
+        search = differential_evolution if method == "de" else cma_es
+        global_result = search(batch_loss_function, x, y, bounds, log_scale, max_evaluations=max_evaluations, seed=seed, n_workers=n_workers, suppress_stdout=suppress_stdout)
+        parameters, loss = global_result.parameters, global_result.loss
+        if not np.isfinite(loss): raise RuntimeError("Во всех точках функция потерь не конечна (переполнение)")
+        info.update(global_result=global_result)
+    elif method == "two_step":
+        global_result = two_step_optimization(x, y, n_workers=n_workers, suppress_stdout=suppress_stdout)
+        parameters, loss = global_result.parameters, global_result.loss
+        info.update(global_result=global_result)
+    elif method != "grid":
+        raise ValueError(f"Неизвестный способ поиска начальной точки: {method}")
+    elif halving:
+        starts = make_grid(start, end, num_of_points)
+        parameters, loss, total_iter = successive_halving(starts, x, y, alpha, batch_size, eta=eta, n_workers=n_workers, suppress_stdout=suppress_stdout)
+        if not suppress_stdout: print(f"Итераций спуска: {total_iter}")
+        info.update(n_starts=len(starts), grid_n_iter=total_iter)
+    else:
+        starts = make_grid(start, end, num_of_points)
+        pb = None if suppress_stdout else ProgressBar(total=num_of_points**4-1,prefix="Progress", suffix='Complete', length=50)
+        results = run_starts(starts, x, y, alpha, n_iter, n_iter_no_change, batch_size, n_workers=n_workers, pb=pb, checkpoint=checkpoint, resume=resume)
+        # Точки с переполнением отбрасываются, потери остальных известны из спусков
+        parameters_arr, loss_arr = rank_results(results)
+        if len(loss_arr) == 0: raise RuntimeError("Все спуски прервались из-за переполнения")
+        loss = np.min(loss_arr)
+        i_min = np.argmin(loss_arr)
+        parameters = parameters_arr[i_min]
+        info.update(n_starts=len(starts), grid_n_iter=n_iter * len(starts))
+    if not suppress_stdout:
+        print("минималки")
+        print(parameters)
+        print(loss)
     n_iter_no_change = 100
     n_iter = 1000
-    new_parameters = minibatch_stochastic_gradient_descent_lf(loss_function, parameters, alpha, n_iter, x, y, batch_size, max_n_iter_no_change=n_iter_no_change)
-    loss = loss_function(*new_parameters, x, y)
-    print("уточнил")
-    print(new_parameters)
-    print(loss)
-
-
+    result = minibatch_stochastic_gradient_descent_lf(loss_function, parameters, alpha, n_iter, x, y, batch_size, max_n_iter_no_change=n_iter_no_change, suppress_stdout=suppress_stdout, return_result=True)
+    result.info.update(grid_parameters=parameters, grid_loss=float(loss), **info)
+    if not suppress_stdout:
+        print("уточнил")
+        print(result.parameters)
+        print(result.loss)
+    return result
@@ -0,0 +1,233 @@
+import numpy as np
+import profiling
+from functions import as_float, rk4_g_array, rk4_g_sensitivity_array, grouped_rk4_g_array
+
+# Numba не обязательна: если она не установлена, используются реализации на numpy из functions.py
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# Использовать ли компилированные ядра (можно выключить, чтобы сравнить с реализацией на numpy)
+USE_NUMBA = njit is not None
+
+
+if njit is not None:
+    @njit(cache=True)
+    def _rk4_step(k1, k2, g0, G_i, h):
+        # Тот же порядок операций, что и в find_g, поэтому результат совпадает с точностью до округления
+        K1 = k2 * (g0 - G_i) - k1 * G_i
+        G_K = G_i + h/2*K1
+        K2 = k2 * (g0 - G_K) - k1 * G_K
+        G_K = G_i + h/2*K2
+        K3 = k2 * (g0 - G_K) - k1 * G_K
+        G_K = G_i + h*K3
+        K4 = k2 * (g0 - G_K) - k1 * G_K
+        return G_i + h/6*(K1+2*K2+2*K3+K4)
+
+    @njit(cache=True)
+    def _rk4_g(k1, k2, g0, time, h):
+        t_i = 0.0
+        G_i = g0
+        n_steps = 0
+        while t_i < time:
+            t_i += h
+            G_i = _rk4_step(k1, k2, g0, G_i, h)
+            n_steps += 1
+        return G_i, n_steps
+
+    @njit(cache=True)
+    def _grouped_rk4_rows(k1, k2, g0, time, order, starts, h, out):
+        # Одна траектория на группу: образцы группы обходятся по возрастанию времени, и значение каждого
+        # записывается на том шаге, на котором остановился бы цикл в _rk4_g
+        total_steps = 0
+        for m in range(out.shape[0]):
+            for g in range(k1.shape[1]):
+                t_i = 0.0
+                G_i = g0[m, g] * 1.0
+                for s in range(starts[g], starts[g + 1]):
+                    j = order[s]
+                    while t_i < time[j]:
+                        t_i += h
+                        G_i = _rk4_step(k1[m, g], k2[m, g], g0[m, g], G_i, h)
+                        total_steps += 1
+                    out[m, j] = G_i
+        return total_steps
+
+    @njit(cache=True)
+    def _rk4_g_samples(k1, k2, g0, time, h, out):
+        total_steps = 0
+        for j in range(out.size):
+            out[j], n_steps = _rk4_g(k1[j], k2[j], g0[j], time[j], h)
+            total_steps += n_steps
+        return total_steps
+
+    @njit(cache=True)
+    def _rk4_g_sensitivity_samples(k1, k2, g0, time, h, G, S1, S2):
+        # Те же формулы и порядок операций, что и в rk4_g_sensitivity_array, но без проходов по всем образцам на каждом шаге
+        total_steps = 0
+        for j in range(G.size):
+            a1 = k1[j]
+            a2 = k2[j]
+            c = g0[j]
+            s = a1 + a2
+            t_i = 0.0
+            G_i = c
+            S1_i = 0.0
+            S2_i = 0.0
+            n_steps = 0
+            while t_i < time[j]:
+                t_i += h
+                KG1 = a2 * (c - G_i) - a1 * G_i
+                KS1_1 = -s * S1_i - G_i
+                KS2_1 = -s * S2_i + (c - G_i)
+                G_K = G_i + h/2*KG1
+                S1_K = S1_i + h/2*KS1_1
+                S2_K = S2_i + h/2*KS2_1
+                KG2 = a2 * (c - G_K) - a1 * G_K
+                KS1_2 = -s * S1_K - G_K
+                KS2_2 = -s * S2_K + (c - G_K)
+                G_K = G_i + h/2*KG2
+                S1_K = S1_i + h/2*KS1_2
+                S2_K = S2_i + h/2*KS2_2
+                KG3 = a2 * (c - G_K) - a1 * G_K
+                KS1_3 = -s * S1_K - G_K
+                KS2_3 = -s * S2_K + (c - G_K)
+                G_K = G_i + h*KG3
+                S1_K = S1_i + h*KS1_3
+                S2_K = S2_i + h*KS2_3
+                KG4 = a2 * (c - G_K) - a1 * G_K
+                KS1_4 = -s * S1_K - G_K
+                KS2_4 = -s * S2_K + (c - G_K)
+                G_i = G_i + h/6*(KG1+2*KG2+2*KG3+KG4)
+                S1_i = S1_i + h/6*(KS1_1+2*KS1_2+2*KS1_3+KS1_4)
+                S2_i = S2_i + h/6*(KS2_1+2*KS2_2+2*KS2_3+KS2_4)
+                n_steps += 1
+            G[j] = G_i
+            S1[j] = S1_i
+            S2[j] = S2_i
+            total_steps += n_steps
+        return total_steps
+
+    @njit(cache=True)
+    def _rk4_sse_rows(k1, k2, g0, time, y, h, out):
+        # Сумма квадратов разностей по каждой строке без промежуточного массива концентраций
+        total_steps = 0
+        for m in range(out.size):
+            sse = 0.0
+            for j in range(k1.shape[1]):
+                G, n_steps = _rk4_g(k1[m, j], k2[m, j], g0[m, j], time[m, j], h)
+                difference = y[m, j] - G
+                sse += difference * difference
+                total_steps += n_steps
+            out[m] = sse
+        return total_steps
+
+
+def _broadcast(*arrays):
+    # Общая форма и непрерывные копии массивов этой формы (для передачи в компилированные ядра). Тип float32 сохраняется,
+    # вычисления в ядрах все равно идут в float64
+    arrays = [as_float(a) for a in arrays]
+    shape = np.broadcast_shapes(*(a.shape for a in arrays))
+    return shape, [np.ascontiguousarray(np.broadcast_to(a, shape)) for a in arrays]
+
+
+def rk4_g_scalar(k1, k2, g0, time, h):
+    """
+    Метод Рунге-Кутты четвертого порядка для одного образца (компилированное ядро, см. find_g).
+    Доступен только при установленной numba
+    :param k1: константа скорости реакции глюкозы
+    :param k2: константа скорости реакции фруктозы
+    :param g0: начальная концентрация глюкозы при t = 0
+    :param time: момент времени t
+    :param h: шаг метода Рунге-Кутты
+    :returns: концентрацию глюкозы в момент времени t
+    """
+    G, n_steps = _rk4_g(float(k1), float(k2), float(g0), float(time), float(h))
+    profiling.count("rk4_steps", n_steps)
+    return G
+
+
+def rk4_g(k1, k2, g0, time, h):
+    """
+    Метод Рунге-Кутты четвертого порядка для массива образцов: компилированное ядро, если доступна numba,
+    иначе functions.rk4_g_array
+    :param k1: константа скорости реакции глюкозы
+    :param k2: константа скорости реакции фруктозы
+    :param g0: начальная концентрация глюкозы при t = 0
+    :param time: момент времени t
+    :param h: шаг метода Рунге-Кутты
+    :returns: массив концентраций глюкозы
+    """
+    if not USE_NUMBA: return rk4_g_array(k1, k2, g0, time, h)
+    shape, (k1, k2, g0, time) = _broadcast(k1, k2, g0, time)
+    G = np.empty(shape)
+    n_steps = _rk4_g_samples(k1.ravel(), k2.ravel(), g0.ravel(), time.ravel(), float(h), G.reshape(-1))
+    profiling.count("rk4_steps", n_steps)
+    return G
+
+
+def rk4_g_sensitivity(k1, k2, g0, time, h):
+    """
+    Метод Рунге-Кутты четвертого порядка вместе с уравнениями чувствительности по k1 и k2:
+    компилированное ядро, если доступна numba, иначе functions.rk4_g_sensitivity_array
+    :param k1: константа скорости реакции глюкозы
+    :param k2: константа скорости реакции фруктозы
+    :param g0: начальная концентрация глюкозы при t = 0
+    :param time: момент времени t
+    :param h: шаг метода Рунге-Кутты
+    :returns: массивы G, dG/dk1, dG/dk2
+    """
+    if not USE_NUMBA: return rk4_g_sensitivity_array(k1, k2, g0, time, h)
+    shape, (k1, k2, g0, time) = _broadcast(k1, k2, g0, time)
+    G, S1, S2 = np.empty(shape), np.empty(shape), np.empty(shape)
+    n_steps = _rk4_g_sensitivity_samples(k1.ravel(), k2.ravel(), g0.ravel(), time.ravel(), float(h), G.reshape(-1), S1.reshape(-1), S2.reshape(-1))
+    profiling.count("rk4_steps", n_steps)
+    return G, S1, S2
+
+
+def grouped_rk4_g(k1, k2, g0, time, group, h, order=None):
+    """
+    Метод Рунге-Кутты четвертого порядка с одним интегрированием на траекторию (группу образцов с общими начальными
+    условиями): компилированное ядро, если доступна numba, иначе functions.grouped_rk4_g_array. Результат совпадает
+    с rk4_g, а количество шагов - сумма по группам наибольшего количества шагов их образцов вместо суммы по образцам
+    :param k1: константы скорости реакции глюкозы для каждой группы (..., n_groups)
+    :param k2: константы скорости реакции фруктозы для каждой группы (..., n_groups)
+    :param g0: начальные концентрации глюкозы для каждой группы (n_groups)
+    :param time: вектор моментов времени образцов (N)
+    :param group: номер группы для каждого образца (N)
+    :param h: шаг метода Рунге-Кутты
+    :param order: порядок образцов по группам и по возрастанию времени (см. dataset.Dataset.order), по умолчанию считается заново
+    :returns: массив концентраций глюкозы формы (..., N)
+    """
+    if not USE_NUMBA: return grouped_rk4_g_array(k1, k2, g0, time, group, h)
+    time = as_float(time)
+    shape, (k1, k2, g0) = _broadcast(k1, k2, g0)
+    G = np.empty(shape[:-1] + time.shape)
+    if time.size == 0: return G
+    if order is None: order = np.lexsort((time, group))
+    # Начало образцов каждой группы в order
+    starts = np.searchsorted(group[order], np.arange(shape[-1] + 1))
+    n_steps = _grouped_rk4_rows(*(a.reshape(-1, shape[-1]) for a in (k1, k2, g0)), time, order, starts, float(h), G.reshape(-1, time.size))
+    profiling.count("rk4_steps", n_steps)
+    return G
+
+
+def rk4_sse(k1, k2, g0, time, y, h):
+    """
+    Сумма квадратов разностей экспериментальных и рассчитанных методом Рунге-Кутты концентраций по последней оси
+    (ось образцов): компилированное ядро, если доступна numba, иначе numpy
+    :param k1: константа скорости реакции глюкозы
+    :param k2: константа скорости реакции фруктозы
+    :param g0: начальная концентрация глюкозы при t = 0
+    :param time: момент времени t
+    :param y: экспериментальные концентрации глюкозы
+    :param h: шаг метода Рунге-Кутты
+    :returns: сумма квадратов разностей (число или массив формы без последней оси)
+    """
+    if not USE_NUMBA: return np.sum((as_float(y) - rk4_g_array(k1, k2, g0, time, h)) ** 2, axis=-1)
+    shape, arrays = _broadcast(k1, k2, g0, time, y)
+    sse = np.empty(shape[:-1])
+    n_steps = _rk4_sse_rows(*(a.reshape(-1, shape[-1]) for a in arrays), float(h), sse.reshape(-1))
+    profiling.count("rk4_steps", n_steps)
+    return sse[()]
@@ -0,0 +1,152 @@
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from scipy.interpolate import RegularGridInterpolator
+import dataset
+from common import worker_data, init_worker, save_npz
+
+# Каталог для сохраненных поверхностей функции потерь
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".surface_cache")
+# Максимальное количество точек сетки в одном вызове пакетной функции потерь (ограничивает память: P x N на вызов)
+TILE_SIZE = 4096
+
+
+def _evaluate_tile(points):
+    with np.errstate(all="ignore"):
+        return worker_data["batch_loss_function"](points, worker_data["x"], worker_data["y"], **worker_data["loss_parameters"])
+
+
+def surface_key(batch_loss_function, x, y, range_1, range_2, num_of_points, loss_parameters=None, refine_levels=0, refine_factor=4, valley=0.05):
+    """
+    Ключ сохраненной поверхности: хеш функции потерь, набора данных, границ и разрешения сетки
+    (параметры те же, что у loss_surface)
+    :return: строка из шестнадцатеричных цифр
+    """
+    digest = hashlib.sha256()
+    digest.update(f"{batch_loss_function.__module__}.{batch_loss_function.__qualname__}".encode())
+    for array in ((x.data,) if isinstance(x, dataset.Dataset) else (x, y)):
+        array = np.ascontiguousarray(array, dtype=np.float64)
+        digest.update(str(array.shape).encode())
+        digest.update(array.tobytes())
+    parameters = sorted((loss_parameters or {}).items())
+    digest.update(repr((tuple(map(float, range_1)), tuple(map(float, range_2)), int(num_of_points), parameters,
+                        int(refine_levels), int(refine_factor), float(valley))).encode())
+    return digest.hexdigest()[:32]
+
+
+def evaluate_points(batch_loss_function, points, x, y, loss_parameters=None, tile_size=TILE_SIZE, n_workers=1, pb=None):
+    """
+    Функция потерь в наборе точек частями не больше tile_size точек, последовательно или в пуле процессов
+    :param batch_loss_function: функция потерь, принимающая матрицу параметров (P, 2) и возвращающая P значений
+    :param points: матрица точек размера (P, 2)
+    :param x: матрица входных данных
+    :param y: вектор экспериментальных данных
+    :param loss_parameters: дополнительные именованные параметры функции потерь (не обязательно)
+    :param tile_size: максимальное количество точек в одном вызове функции потерь
+    :param n_workers: количество процессов (1 - без пула, None - по числу ядер)
+    :param pb: индикатор прогресса по частям (не обязательно)
+    :return: вектор из P значений функции потерь (inf для точек с переполнением)
+    """
+    if n_workers is None: n_workers = os.cpu_count()
+    loss_parameters = loss_parameters or {}
+    tiles = [points[start:start + tile_size] for start in range(0, len(points), tile_size)]
+    results = []
+    data = {"batch_loss_function": batch_loss_function, "x": x, "y": y, "loss_parameters": loss_parameters}
+    if n_workers <= 1 or len(tiles) <= 1:
+        init_worker(data)
+        for i, tile in enumerate(tiles):
+            results.append(_evaluate_tile(tile))
+            if pb is not None: pb.print_progress_bar(i)
+        worker_data.clear()
+    else:
+        data["x"], data["y"] = dataset.as_arrays(x, y)
+        with ProcessPoolExecutor(min(n_workers, len(tiles)), initializer=init_worker, initargs=(data,)) as executor:
+            for i, loss in enumerate(executor.map(_evaluate_tile, tiles)):
+                results.append(loss)
+                if pb is not None: pb.print_progress_bar(i)
+    loss = np.concatenate(results) if results else np.empty(0)
+    return np.where(np.isfinite(loss), loss, np.inf)
+
+
+def save_surface(path, axis_1, axis_2, loss):
+    """
+    Сохранение поверхности в файл .npz (через временный файл, чтобы прерывание не оставило испорченный файл)
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    save_npz(path, axis_1=axis_1, axis_2=axis_2, loss=loss)
+
+
+def load_surface(path):
+    """
+    Загрузка поверхности, сохраненной save_surface
+    :return: axis_1, axis_2, loss
+    """
+    with np.load(path) as data:
+        return data["axis_1"], data["axis_2"], data["loss"]
+
+
+def _valley_nodes(loss, factor, valley):
+    # Узлы мелкой сетки, лежащие в ячейках крупной сетки, хотя бы один угол которых попал в нижнюю долю valley значений
+    finite = loss[np.isfinite(loss)]
+    if len(finite) == 0: return np.zeros(((loss.shape[0] - 1) * factor + 1, (loss.shape[1] - 1) * factor + 1), dtype=bool)
+    low = loss <= np.quantile(finite, valley)
+    cells = low[:-1, :-1] | low[1:, :-1] | low[:-1, 1:] | low[1:, 1:]
+    mask = np.zeros(((loss.shape[0] - 1) * factor + 1, (loss.shape[1] - 1) * factor + 1), dtype=bool)
+    for i, j in zip(*np.nonzero(cells)):
+        mask[i * factor:(i + 1) * factor + 1, j * factor:(j + 1) * factor + 1] = True
+    return mask
+
+
+def loss_surface(batch_loss_function, x, y, range_1, range_2, num_of_points, loss_parameters=None, refine_levels=0, refine_factor=4, valley=0.05,
+                 tile_size=TILE_SIZE, n_workers=1, cache_dir=CACHE_DIR, suppress_stdout=False):
+    """
+    Поверхность функции потерь двух параметров на сетке. Сетка считается частями (см. evaluate_points),
+    готовая поверхность сохраняется в cache_dir и при повторном вызове с теми же аргументами читается с диска.
+    При адаптивном уточнении разрешение каждый раз увеличивается в refine_factor раз, но функция потерь считается
+    только в ячейках около долины минимума, в остальных узлах значения интерполируются по предыдущему уровню
+    :param batch_loss_function: функция потерь, принимающая матрицу параметров (P, 2) и возвращающая P значений
+    :param x: матрица входных данных
+    :param y: вектор экспериментальных данных
+    :param range_1: границы первого параметра
+    :param range_2: границы второго параметра
+    :param num_of_points: количество точек по каждому параметру до уточнения
+    :param loss_parameters: дополнительные именованные параметры функции потерь (не обязательно)
+    :param refine_levels: количество уровней адаптивного уточнения
+    :param refine_factor: во сколько раз увеличивается разрешение на каждом уровне
+    :param valley: доля наименьших значений функции потерь, ячейки с которыми уточняются
+    :param tile_size: максимальное количество точек в одном вызове функции потерь
+    :param n_workers: количество процессов (1 - без пула, None - по числу ядер)
+    :param cache_dir: каталог для сохраненных поверхностей (None - не сохранять)
+    :param suppress_stdout: не выводить сообщения
+    :return: ось первого параметра, ось второго параметра и матрица потерь размера (len(axis_2), len(axis_1))
+    в порядке np.meshgrid(axis_1, axis_2)
+    """
+    path = None
+    if cache_dir is not None:
+        key = surface_key(batch_loss_function, x, y, range_1, range_2, num_of_points, loss_parameters, refine_levels, refine_factor, valley)
+        path = os.path.join(cache_dir, key + ".npz")
+        if os.path.exists(path): return load_surface(path)
+    if refine_levels == 0:
+        axis_1 = np.linspace(range_1[0], range_1[1], num_of_points)
+        axis_2 = np.linspace(range_2[0], range_2[1], num_of_points)
+        grid_1, grid_2 = np.meshgrid(axis_1, axis_2)
+        points = np.stack((grid_1.ravel(), grid_2.ravel()), axis=-1)
+        if not suppress_stdout: print(f"Расчет поверхности функции потерь: {len(points)} точек")
+        loss = evaluate_points(batch_loss_function, points, x, y, loss_parameters, tile_size, n_workers).reshape(grid_1.shape)
+    else:
+        coarse_1, coarse_2, coarse = loss_surface(batch_loss_function, x, y, range_1, range_2, num_of_points, loss_parameters, refine_levels - 1,
+                                                  refine_factor, valley, tile_size, n_workers, cache_dir, suppress_stdout)
+        axis_1 = np.linspace(coarse_1[0], coarse_1[-1], (len(coarse_1) - 1) * refine_factor + 1)
+        axis_2 = np.linspace(coarse_2[0], coarse_2[-1], (len(coarse_2) - 1) * refine_factor + 1)
+        grid_1, grid_2 = np.meshgrid(axis_1, axis_2)
+        # Бесконечные значения (переполнение) не должны портить интерполяцию в соседних ячейках
+        finite = coarse[np.isfinite(coarse)]
+        fill = finite.max() if len(finite) else 0.0
+        interpolator = RegularGridInterpolator((coarse_2, coarse_1), np.where(np.isfinite(coarse), coarse, fill))
+        loss = interpolator(np.stack((grid_2, grid_1), axis=-1))
+        mask = _valley_nodes(coarse, refine_factor, valley)
+        if not suppress_stdout: print(f"Уточнение поверхности функции потерь: {np.count_nonzero(mask)} точек из {mask.size}")
+        loss[mask] = evaluate_points(batch_loss_function, np.stack((grid_1[mask], grid_2[mask]), axis=-1), x, y, loss_parameters, tile_size, n_workers)
+    if path is not None: save_surface(path, axis_1, axis_2, loss)
+    return axis_1, axis_2, loss
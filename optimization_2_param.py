@@ -1,10 +1,16 @@
 import numpy as np
-from SGD import gradient_descent_lf, stochastic_gradient_descent_lf, minibatch_stochastic_gradient_descent_lf
+from SGD import gradient_descent_lf, stochastic_gradient_descent_lf, minibatch_stochastic_gradient_descent_lf, levenberg_marquardt_lf
 import matplotlib.pyplot as plt
+from functions import as_float, nonfinite_to_inf, analytic_g, analytic_g_array, group_samples, dopri5_g, grouped_dopri5_g, analytic_g_sensitivity_array
+from dif_eq_lib import solve_dif_eq
+import profiling
+import kernels
+import dataset
+from cache import cached_rk4_g
 
 # Метод Рунге-Кутты четвертого порядка для вычисления текущей концентрации глюкозы
 
-def find_g(k1, k2, g0, time, h=0.5):
+def find_g(k1, k2, g0, time, h=0.5, method="rk4"):
     """
     Расчет концентрации глюкозы в момент времени t
     :param k1: константа скорости реакции глюкозы
@@ -12,8 +18,19 @@ def find_g(k1, k2, g0, time, h=0.5):
     :param g0: начальная концентрация глюкозы при t = 0
     :param time: момент времени t
     :param h: шаг метода Рунге-Кутты
+    :param method: способ решения ДУ: "rk4" (Рунге-Кутта), "cached" (Рунге-Кутта с кэшированием траекторий, см. cache.py),
+    "grouped" (Рунге-Кутта, одно интегрирование на траекторию, см. kernels.grouped_rk4_g; результат тот же, что и у "rk4",
+    для одного образца считается как "rk4"), "dopri5" (Дорман-Принс с адаптивным шагом, см. functions.dopri5_g), "odeint" (scipy) или "analytic" (точное решение)
     :returns: концентрацию глюкозы в момент времени t
     """
+    profiling.count("find_g")
+    if method == "analytic": return analytic_g(k1, k2, g0, time)
+    if method == "cached": return cached_rk4_g(k1, k2, g0, time, h)
+    if method == "dopri5": return float(dopri5_g(k1, k2, g0, [time])[0][0])
+    if method == "odeint": return solve_dif_eq(g0, time, k1, k2)
+    if method not in ("rk4", "grouped"): raise ValueError(f"Неизвестный метод решения ДУ: {method}")
+    # Компилированное ядро с тем же циклом, если установлена numba (см. kernels.py)
+    if kernels.USE_NUMBA: return kernels.rk4_g_scalar(k1, k2, g0, time, h)
     # Функция расчета производной концентрации глюкозы по времени
     def f(g): return k2 * (g0 - g) - k1 * g
     # Нулевой момент времени
@@ -30,26 +47,160 @@ def find_g(k1, k2, g0, time, h=0.5):
         K4 = f(G_i + h*K3)
         # значение концентрации для t_i + h
         G_i += h/6*(K1+2*K2+2*K3+K4)
+    profiling.count("rk4_steps", round(t_i / h))
     return G_i
 
-def loss_function(k1, k2, x, y):
+def find_g_array(k1, k2, g0, time, h=0.5, method="rk4", groups=None, order=None):
+    """
+    Расчет концентраций глюкозы сразу для массива образцов
+    :param k1: константа скорости реакции глюкозы (число или массив, тогда ось образцов добавляется последней)
+    :param k2: константа скорости реакции фруктозы (число или массив той же формы, что и k1)
+    :param g0: вектор начальных концентраций глюкозы
+    :param time: вектор моментов времени
+    :param h: шаг метода Рунге-Кутты
+    :param method: способ решения ДУ (см. find_g)
+    :param groups: группы образцов для "grouped" и "dopri5" (см. functions.group_samples, Dataset.groups), первый столбец ключей - g0, по умолчанию считаются заново
+    :param order: порядок образцов по группам и времени для "grouped" (см. Dataset.order, только вместе с groups), по умолчанию считается заново
+    :returns: массив концентраций глюкозы формы (*shape(k1), len(time))
+    """
+    profiling.count("find_g")
+    k1 = np.asarray(k1, dtype=float)[..., np.newaxis]
+    k2 = np.asarray(k2, dtype=float)[..., np.newaxis]
+    g0, time = as_float(g0), as_float(time)
+    if method == "analytic": return analytic_g_array(k1, k2, g0, time)
+    if method == "odeint": return np.vectorize(solve_dif_eq)(g0, time, k1, k2)
+    if method == "cached": return np.vectorize(cached_rk4_g)(k1, k2, g0, time, h)
+    if method == "grouped":
+        keys, group = group_samples(g0) if groups is None else groups
+        return kernels.grouped_rk4_g(k1, k2, keys[:, 0], time, group, h, order)
+    if method == "dopri5":
+        keys, group = group_samples(g0) if groups is None else groups
+        return grouped_dopri5_g(k1, k2, keys[:, 0], time, group)[0]
+    if method != "rk4": raise ValueError(f"Неизвестный метод решения ДУ: {method}")
+    return kernels.rk4_g(k1, k2, g0, time, h)
+
+def find_sse_array(k1, k2, g0, time, y, h=0.5, method="rk4", groups=None, order=None):
+    """
+    Сумма квадратов разностей экспериментальных и расчетных концентраций глюкозы по образцам
+    :param k1: константа скорости реакции глюкозы (число или массив, тогда ось образцов добавляется последней)
+    :param k2: константа скорости реакции фруктозы (число или массив той же формы, что и k1)
+    :param g0: вектор начальных концентраций глюкозы
+    :param time: вектор моментов времени
+    :param y: вектор экспериментальных концентраций глюкозы
+    :param h: шаг метода Рунге-Кутты
+    :param method: способ решения ДУ (см. find_g). Для "rk4" сумма считается без промежуточного массива концентраций (см. kernels.rk4_sse)
+    :param groups: группы образцов (см. find_g_array)
+    :param order: порядок образцов (см. find_g_array)
+    :returns: сумма квадратов разностей формы shape(k1)
+    """
+    y = as_float(y)
+    if method != "rk4": return np.sum((y - find_g_array(k1, k2, g0, time, h, method, groups, order)) ** 2, axis=-1)
+    profiling.count("find_g")
+    k1 = np.asarray(k1, dtype=float)[..., np.newaxis]
+    k2 = np.asarray(k2, dtype=float)[..., np.newaxis]
+    return kernels.rk4_sse(k1, k2, as_float(g0), as_float(time), y, h)
+
+def find_g_jacobian_array(k1, k2, g0, time, h=0.5, method="rk4"):
+    """
+    Расчет концентраций глюкозы и их производных по параметрам модели для массива образцов
+    :param k1: константа скорости реакции глюкозы (число или массив, тогда ось образцов добавляется последней)
+    :param k2: константа скорости реакции фруктозы (число или массив той же формы, что и k1)
+    :param g0: вектор начальных концентраций глюкозы
+    :param time: вектор моментов времени
+    :param h: шаг метода Рунге-Кутты
+    :param method: способ решения ДУ (см. find_g), для "odeint" и "dopri5" используются производные точного решения
+    :returns: массив концентраций глюкозы формы (..., N) и матрицу Якоби dG/d(k1, k2) формы (..., N, 2)
+    """
+    profiling.count("find_g")
+    k1 = np.asarray(k1, dtype=float)[..., np.newaxis]
+    k2 = np.asarray(k2, dtype=float)[..., np.newaxis]
+    g0, time = as_float(g0), as_float(time)
+    if method in ("rk4", "cached", "grouped"): G, dG_dk1, dG_dk2 = kernels.rk4_g_sensitivity(k1, k2, g0, time, h)
+    elif method in ("analytic", "odeint", "dopri5"): G, dG_dk1, dG_dk2 = analytic_g_sensitivity_array(k1, k2, g0, time)
+    else: raise ValueError(f"Неизвестный метод решения ДУ: {method}")
+    return G, np.stack((dG_dk1, dG_dk2), axis=-1)
+
+def loss_function(k1, k2, x, y, method="rk4"):
     """
     Функция потерь для модели
     :param k1: константа скорости реакции глюкозы
     :param k2: константа скорости реакции фруктозы
-    :param x: матрица входных данных, каждая строчка содержит начальную концентрацию глюкозы, температуру и время
-    :param y: вектор экспериментальных данных, концентраций глюкозы
+    :param x: матрица входных данных, каждая строчка содержит начальную концентрацию глюкозы и время, или dataset.Dataset
+    :param y: вектор экспериментальных данных, концентраций глюкозы (None, если x - Dataset)
+    :param method: способ решения ДУ (см. find_g)
     :return: Сумма квадратов разностей расчетной концентрации глюкозы и экспериментальной
     """
-    # Инициализация потерь
-    loss = 0
-    # Расчет потерь
-    if isinstance(y, (float, int)): return (y - find_g(k1, k2, *x)) ** 2
-    for i in range(len(x)):
-        loss += (y[i] - find_g(k1, k2, *x[i])) ** 2
-    # Очень важно, чтобы величина функции потерь не зависела от количества входных данных. Для этого, например, можно вычислять среднее суммы
-    # Иначе параметр alpha (скорость спуска) будет необходимо подбирать, например, отдельно, для каждого размера пакета
-    return loss/len(x)
+    # Расчет потерь для одного образца
+    if isinstance(y, (float, int)):
+        difference = y - find_g(k1, k2, *x, method=method)
+        return nonfinite_to_inf(difference * difference)
+    # Расчет потерь сразу для всех образцов (столбцы Dataset используются без преобразований)
+    (g0, time), y = dataset.columns(x, y, 2)
+    # Переполнение при расходящемся решении ДУ не прерывает расчет, а дает бесконечную функцию потерь
+    with np.errstate(over="ignore", invalid="ignore"):
+        # Очень важно, чтобы величина функции потерь не зависела от количества входных данных. Для этого, например, можно вычислять среднее суммы
+        # Иначе параметр alpha (скорость спуска) будет необходимо подбирать, например, отдельно, для каждого размера пакета
+        loss = find_sse_array(k1, k2, g0, time, y, method=method, groups=dataset.groups(x),
+                              order=dataset.order(x) if method == "grouped" else None) / len(y)
+    return nonfinite_to_inf(loss)
+
+def gradient_function(k1, k2, x, y, method="rk4"):
+    """
+    Точный градиент функции потерь по k1, k2 (используется в SGD.py вместо центральной разности)
+    :param k1: константа скорости реакции глюкозы
+    :param k2: константа скорости реакции фруктозы
+    :param x: матрица входных данных, одна строчка или dataset.Dataset
+    :param y: вектор экспериментальных данных или одно значение (None, если x - Dataset)
+    :param method: способ решения ДУ (см. find_g)
+    :return: вектор градиента функции потерь
+    """
+    (g0, time), y = dataset.columns(x, y, 2)
+    # При переполнении градиент содержит nan или inf, такие шаги отбрасываются оптимизаторами SGD.py
+    with np.errstate(over="ignore", invalid="ignore"):
+        G, J = find_g_jacobian_array(k1, k2, g0, time, method=method)
+        return np.mean(-2 * (y - G)[..., np.newaxis] * J, axis=-2)
+
+def residual_jacobian_function(k1, k2, x, y, method="rk4"):
+    """
+    Вектор невязок y - G и его матрица Якоби по параметрам модели (используется методом Левенберга-Марквардта в SGD.py)
+    :param k1: константа скорости реакции глюкозы
+    :param k2: константа скорости реакции фруктозы
+    :param x: матрица входных данных, одна строчка или dataset.Dataset
+    :param y: вектор экспериментальных данных или одно значение (None, если x - Dataset)
+    :param method: способ решения ДУ (см. find_g)
+    :return: вектор невязок размера N и матрицу Якоби размера (N, 2)
+    """
+    (g0, time), y = dataset.columns(x, y, 2)
+    with np.errstate(over="ignore", invalid="ignore"):
+        G, J = find_g_jacobian_array(k1, k2, g0, time, method=method)
+    return y - G, -J
+
+# Функции SGD.py используют аналитический градиент и матрицу Якоби, если они доступны у функции потерь
+loss_function.gradient = gradient_function
+loss_function.residual_jacobian = residual_jacobian_function
+
+def batch_loss_function(parameters, x, y, method="rk4", chunk_size=None):
+    """
+    Функция потерь сразу для набора параметров модели (вычисляется как тензор P x N за один вызов)
+    :param parameters: матрица параметров размера (P, 2), каждая строчка содержит k1, k2
+    :param x: матрица входных данных, одна строчка или dataset.Dataset
+    :param y: вектор экспериментальных данных, концентраций глюкозы, или одно значение (None, если x - Dataset)
+    :param method: способ решения ДУ (см. find_g)
+    :param chunk_size: максимальное количество наборов параметров в одном вызове, чтобы ограничить память (не обязательно)
+    :return: вектор из P значений функции потерь
+    """
+    parameters = np.atleast_2d(np.asarray(parameters, dtype=float))
+    # Один образец тоже считается векторизованным путем (скалярный путь loss_function не принимает массивы параметров)
+    if not isinstance(x, dataset.Dataset): x, y = np.atleast_2d(np.asarray(x, dtype=float)), np.atleast_1d(np.asarray(y, dtype=float))
+    if chunk_size is None: chunk_size = max(len(parameters), 1)
+    loss = np.empty(len(parameters))
+    for start in range(0, len(parameters), chunk_size):
+        chunk = parameters[start:start + chunk_size]
+        loss[start:start + chunk_size] = loss_function(*chunk.T, x, y, method=method)
+    return loss
+
+# Пакетная функция потерь для градиента по формуле центральной разности (см. SGD.gradient_lf)
+loss_function.batch = batch_loss_function
 
 def generate_data(seed):
     """
@@ -115,6 +266,12 @@ def optimize():
     print(f"Функция потерь для оптимизированных параметров: {lost_mbsgd:.3}")
     print(f"Дельта: {lost_mbsgd - real_lost:.3}\n")
 
+    parameters_lm = levenberg_marquardt_lf(loss_function, initial_parameters, 0.001, 100, x, y)
+    lost_lm = loss_function(*parameters_lm, x, y)
+    print(f"\nОптимизированные параметры: k1 = {parameters_lm[0]:.3e}, k2 = {parameters_lm[1]:.3e}")
+    print(f"Функция потерь для оптимизированных параметров: {lost_lm:.3}")
+    print(f"Дельта: {lost_lm - real_lost:.3}\n")
+
     # Построение графиков
     t_10 = []
     g_10 = []
@@ -1,15 +1,22 @@
 import numpy as np
 import matplotlib.pyplot as plt
-from functions import find_k
-from SGD import gradient_descent_lf, stochastic_gradient_descent_lf, minibatch_stochastic_gradient_descent_lf
+from functions import as_float, nonfinite_to_inf, find_k, find_k_array, analytic_g, analytic_g_array, group_samples, dopri5_g, grouped_dopri5_g, analytic_g_sensitivity_array
+from dif_eq_lib import solve_dif_eq
+import profiling
+import kernels
+import dataset
+from cache import cached_find_k, cached_rk4_g
+from SGD import gradient_descent_lf, stochastic_gradient_descent_lf, minibatch_stochastic_gradient_descent_lf, levenberg_marquardt_lf
 
 # Универсальная газовая постоянная
 R = 1.987
+# Температура, относительно которой центрируется логарифмическая параметризация (середина диапазона данных)
+REFERENCE_TEMP = 333.15
 
 
 # Метод Рунге-Кутты четвертого порядка для вычисления текущей концентрации глюкозы
 
-def find_g(k0_1, en1, k0_2, en2, g0, temp, time, h=0.1):
+def find_g(k0_1, en1, k0_2, en2, g0, temp, time, h=0.1, method="rk4"):
     """
     Расчет концентрации глюкозы в момент времени t
     :param k0_1: пред экспоненциальный фактор для глюкозы
@@ -20,13 +27,25 @@ def find_g(k0_1, en1, k0_2, en2, g0, temp, time, h=0.1):
     :param temp: температура при которой происходит реакция
     :param time: момент времени t
     :param h: шаг метода Рунге-Кутты
+    :param method: способ решения ДУ: "rk4" (Рунге-Кутта), "cached" (Рунге-Кутта с кэшированием констант скорости
+    и траекторий, см. cache.py), "grouped" (Рунге-Кутта, одно интегрирование на траекторию, см. kernels.grouped_rk4_g;
+    результат тот же, что и у "rk4", для одного образца считается как "rk4"), "dopri5" (Дорман-Принс с адаптивным шагом,
+    см. functions.dopri5_g), "odeint" (scipy) или "analytic" (точное решение)
     :returns: концентрацию глюкозы в момент времени t
     """
+    profiling.count("find_g")
+    if method == "cached": return cached_rk4_g(cached_find_k(k0_1, en1, temp), cached_find_k(k0_2, en2, temp), g0, time, h)
+    # Константы скорости не зависят от времени, поэтому считаются один раз
+    k2 = find_k(k0_2, en2, temp)
+    k1 = find_k(k0_1, en1, temp)
+    if method == "analytic": return analytic_g(k1, k2, g0, time)
+    if method == "odeint": return solve_dif_eq(g0, time, k1, k2)
+    if method == "dopri5": return float(dopri5_g(k1, k2, g0, [time])[0][0])
+    if method not in ("rk4", "grouped"): raise ValueError(f"Неизвестный метод решения ДУ: {method}")
+    # Компилированное ядро с тем же циклом, если установлена numba (см. kernels.py)
+    if kernels.USE_NUMBA: return kernels.rk4_g_scalar(k1, k2, g0, time, h)
     # Функция расчета производной концентрации глюкозы по времени
-    def f(g):
-        k2 = find_k(k0_2, en2, temp)
-        k1 = find_k(k0_1, en1, temp)
-        return k2 * (g0 - g) - k1 * g
+    def f(g): return k2 * (g0 - g) - k1 * g
     # Нулевой момент времени
     t_i = 0
     # Значение концентрации глюкозы в момент времени t_1
@@ -41,30 +60,278 @@ def find_g(k0_1, en1, k0_2, en2, g0, temp, time, h=0.1):
         K4 = f(G_i + h*K3)
         # значение концентрации для t_i + h
         G_i += h/6*(K1+2*K2+2*K3+K4)
+    profiling.count("rk4_steps", round(t_i / h))
     return G_i
 
-def loss_function(k0_1, en1, k0_2, en2, x, y):
+def find_g_array(k0_1, en1, k0_2, en2, g0, temp, time, h=0.1, method="rk4", groups=None, order=None):
+    """
+    Расчет концентраций глюкозы сразу для массива образцов
+    :param k0_1: пред экспоненциальный фактор для глюкозы (число или массив, тогда ось образцов добавляется последней)
+    :param en1: энергия активации для глюкозы
+    :param k0_2: пред экспоненциальный фактор для фруктозы
+    :param en2: энергия активации для фруктозы
+    :param g0: вектор начальных концентраций глюкозы
+    :param temp: вектор температур
+    :param time: вектор моментов времени
+    :param h: шаг метода Рунге-Кутты
+    :param method: способ решения ДУ (см. find_g)
+    :param groups: группы образцов по g0 и температуре для "grouped" и "dopri5" (см. functions.group_samples, Dataset.groups), по умолчанию считаются заново
+    :param order: порядок образцов по группам и времени для "grouped" (см. Dataset.order, только вместе с groups), по умолчанию считается заново
+    :returns: массив концентраций глюкозы формы (*shape(k0_1), len(time))
+    """
+    profiling.count("find_g")
+    k0_1, en1, k0_2, en2 = (np.asarray(p, dtype=float)[..., np.newaxis] for p in (k0_1, en1, k0_2, en2))
+    g0, temp, time = as_float(g0), as_float(temp), as_float(time)
+    if method == "cached":
+        k2 = np.vectorize(cached_find_k)(k0_2, en2, temp)
+        k1 = np.vectorize(cached_find_k)(k0_1, en1, temp)
+        return np.vectorize(cached_rk4_g)(k1, k2, g0, time, h)
+    if method == "grouped":
+        keys, group = group_samples(g0, temp) if groups is None else groups
+        k2 = find_k_array(k0_2, en2, keys[:, 1])
+        k1 = find_k_array(k0_1, en1, keys[:, 1])
+        return kernels.grouped_rk4_g(k1, k2, keys[:, 0], time, group, h, order)
+    if method == "dopri5":
+        keys, group = group_samples(g0, temp) if groups is None else groups
+        k2 = find_k_array(k0_2, en2, keys[:, 1])
+        k1 = find_k_array(k0_1, en1, keys[:, 1])
+        return grouped_dopri5_g(k1, k2, keys[:, 0], time, group)[0]
+    k2 = find_k_array(k0_2, en2, temp)
+    k1 = find_k_array(k0_1, en1, temp)
+    if method == "analytic": return analytic_g_array(k1, k2, g0, time)
+    if method == "odeint": return np.vectorize(solve_dif_eq)(g0, time, k1, k2)
+    if method != "rk4": raise ValueError(f"Неизвестный метод решения ДУ: {method}")
+    return kernels.rk4_g(k1, k2, g0, time, h)
+
+def find_sse_array(k0_1, en1, k0_2, en2, g0, temp, time, y, h=0.1, method="rk4", groups=None, order=None):
+    """
+    Сумма квадратов разностей экспериментальных и расчетных концентраций глюкозы по образцам
+    :param k0_1: пред экспоненциальный фактор для глюкозы (число или массив, тогда ось образцов добавляется последней)
+    :param en1: энергия активации для глюкозы
+    :param k0_2: пред экспоненциальный фактор для фруктозы
+    :param en2: энергия активации для фруктозы
+    :param g0: вектор начальных концентраций глюкозы
+    :param temp: вектор температур
+    :param time: вектор моментов времени
+    :param y: вектор экспериментальных концентраций глюкозы
+    :param h: шаг метода Рунге-Кутты
+    :param method: способ решения ДУ (см. find_g). Для "rk4" сумма считается без промежуточного массива концентраций (см. kernels.rk4_sse)
+    :param groups: группы образцов (см. find_g_array)
+    :param order: порядок образцов (см. find_g_array)
+    :returns: сумма квадратов разностей формы shape(k0_1)
+    """
+    y = as_float(y)
+    if method != "rk4": return np.sum((y - find_g_array(k0_1, en1, k0_2, en2, g0, temp, time, h, method, groups, order)) ** 2, axis=-1)
+    profiling.count("find_g")
+    k0_1, en1, k0_2, en2 = (np.asarray(p, dtype=float)[..., np.newaxis] for p in (k0_1, en1, k0_2, en2))
+    temp = as_float(temp)
+    k2 = find_k_array(k0_2, en2, temp)
+    k1 = find_k_array(k0_1, en1, temp)
+    return kernels.rk4_sse(k1, k2, as_float(g0), as_float(time), y, h)
+
+def find_g_jacobian_array(k0_1, en1, k0_2, en2, g0, temp, time, h=0.1, method="rk4"):
+    """
+    Расчет концентраций глюкозы и их производных по параметрам модели для массива образцов
+    :param k0_1: пред экспоненциальный фактор для глюкозы (число или массив, тогда ось образцов добавляется последней)
+    :param en1: энергия активации для глюкозы
+    :param k0_2: пред экспоненциальный фактор для фруктозы
+    :param en2: энергия активации для фруктозы
+    :param g0: вектор начальных концентраций глюкозы
+    :param temp: вектор температур
+    :param time: вектор моментов времени
+    :param h: шаг метода Рунге-Кутты
+    :param method: способ решения ДУ (см. find_g), для "odeint" и "dopri5" используются производные точного решения
+    :returns: массив концентраций глюкозы формы (..., N) и матрицу Якоби dG/d(k0_1, en1, k0_2, en2) формы (..., N, 4)
+    """
+    profiling.count("find_g")
+    k0_1, en1, k0_2, en2 = (np.asarray(p, dtype=float)[..., np.newaxis] for p in (k0_1, en1, k0_2, en2))
+    g0, temp, time = as_float(g0), as_float(temp), as_float(time)
+    # exp(-en/(R*T)) - производная константы скорости по пред экспоненциальному фактору
+    e2 = find_k_array(1.0, en2, temp)
+    e1 = find_k_array(1.0, en1, temp)
+    k2 = k0_2 * e2
+    k1 = k0_1 * e1
+    if method in ("rk4", "cached", "grouped"): G, dG_dk1, dG_dk2 = kernels.rk4_g_sensitivity(k1, k2, g0, time, h)
+    elif method in ("analytic", "odeint", "dopri5"): G, dG_dk1, dG_dk2 = analytic_g_sensitivity_array(k1, k2, g0, time)
+    else: raise ValueError(f"Неизвестный метод решения ДУ: {method}")
+    # dk/den = -k/(R*T)
+    RT = np.multiply(R, temp, dtype=float)
+    J = np.stack((dG_dk1 * e1, -dG_dk1 * k1 / RT, dG_dk2 * e2, -dG_dk2 * k2 / RT), axis=-1)
+    return G, J
+
+def loss_function(k0_1, en1, k0_2, en2, x, y, method="rk4"):
     """
     Функция потерь для модели
     :param k0_1: пред экспоненциальный фактор для глюкозы
     :param en1: энергия активации для глюкозы
     :param k0_2: пред экспоненциальный фактор для фруктозы
     :param en2: энергия активации для фруктозы
-    :param x: матрица входных данных, каждая строчка содержит начальную концентрацию глюкозы, температуру и время
-    :param y: вектор экспериментальных данных, концентраций глюкозы
+    :param x: матрица входных данных, каждая строчка содержит начальную концентрацию глюкозы, температуру и время, или dataset.Dataset
+    :param y: вектор экспериментальных данных, концентраций глюкозы (None, если x - Dataset)
+    :param method: способ решения ДУ (см. find_g)
     :return: Сумма квадратов разностей расчетной концентрации глюкозы и экспериментальной
     """
-    # Инициализация потерь
-    loss = 0
-    # Расчет потерь
+    # Расчет потерь для одного образца
     if isinstance(y, (float, int)):
-        y_r = find_g(k0_1, en1, k0_2, en2, *x)
-        return (y - y_r) ** 2
-    for i in range(len(x)):
-        loss += (y[i] - find_g(k0_1, en1, k0_2, en2, *x[i])) ** 2
-    # Очень важно, чтобы величина функции потерь не зависела от количества входных данных. Для этого, например, можно вычислять среднее суммы
-    # Иначе параметр alpha (скорость спуска) будет необходимо подбирать, например, отдельно, для каждого размера пакета
-    return loss/len(x)
+        y_r = find_g(k0_1, en1, k0_2, en2, *x, method=method)
+        return nonfinite_to_inf((y - y_r) * (y - y_r))
+    # Расчет потерь сразу для всех образцов (столбцы Dataset используются без преобразований)
+    (g0, temp, time), y = dataset.columns(x, y, 3)
+    # Переполнение при расходящемся решении ДУ не прерывает расчет, а дает бесконечную функцию потерь
+    with np.errstate(over="ignore", invalid="ignore"):
+        # Очень важно, чтобы величина функции потерь не зависела от количества входных данных. Для этого, например, можно вычислять среднее суммы
+        # Иначе параметр alpha (скорость спуска) будет необходимо подбирать, например, отдельно, для каждого размера пакета
+        loss = find_sse_array(k0_1, en1, k0_2, en2, g0, temp, time, y, method=method, groups=dataset.groups(x),
+                              order=dataset.order(x) if method == "grouped" else None) / len(y)
+    return nonfinite_to_inf(loss)
+
+def gradient_function(k0_1, en1, k0_2, en2, x, y, method="rk4"):
+    """
+    Точный градиент функции потерь по k0_1, en1, k0_2, en2 (используется в SGD.py вместо центральной разности)
+    :param k0_1: пред экспоненциальный фактор для глюкозы
+    :param en1: энергия активации для глюкозы
+    :param k0_2: пред экспоненциальный фактор для фруктозы
+    :param en2: энергия активации для фруктозы
+    :param x: матрица входных данных, одна строчка или dataset.Dataset
+    :param y: вектор экспериментальных данных или одно значение (None, если x - Dataset)
+    :param method: способ решения ДУ (см. find_g)
+    :return: вектор градиента функции потерь
+    """
+    (g0, temp, time), y = dataset.columns(x, y, 3)
+    # При переполнении градиент содержит nan или inf, такие шаги отбрасываются оптимизаторами SGD.py
+    with np.errstate(over="ignore", invalid="ignore"):
+        G, J = find_g_jacobian_array(k0_1, en1, k0_2, en2, g0, temp, time, method=method)
+        return np.mean(-2 * (y - G)[..., np.newaxis] * J, axis=-2)
+
+def residual_jacobian_function(k0_1, en1, k0_2, en2, x, y, method="rk4"):
+    """
+    Вектор невязок y - G и его матрица Якоби по параметрам модели (используется методом Левенберга-Марквардта в SGD.py)
+    :param k0_1: пред экспоненциальный фактор для глюкозы
+    :param en1: энергия активации для глюкозы
+    :param k0_2: пред экспоненциальный фактор для фруктозы
+    :param en2: энергия активации для фруктозы
+    :param x: матрица входных данных, одна строчка или dataset.Dataset
+    :param y: вектор экспериментальных данных или одно значение (None, если x - Dataset)
+    :param method: способ решения ДУ (см. find_g)
+    :return: вектор невязок размера N и матрицу Якоби размера (N, 4)
+    """
+    (g0, temp, time), y = dataset.columns(x, y, 3)
+    with np.errstate(over="ignore", invalid="ignore"):
+        G, J = find_g_jacobian_array(k0_1, en1, k0_2, en2, g0, temp, time, method=method)
+    return y - G, -J
+
+# Функции SGD.py используют аналитический градиент и матрицу Якоби, если они доступны у функции потерь
+loss_function.gradient = gradient_function
+loss_function.residual_jacobian = residual_jacobian_function
+
+def batch_loss_function(parameters, x, y, method="rk4", chunk_size=None):
+    """
+    Функция потерь сразу для набора параметров модели (вычисляется как тензор P x N за один вызов)
+    :param parameters: матрица параметров размера (P, 4), каждая строчка содержит k0_1, en1, k0_2, en2
+    :param x: матрица входных данных, одна строчка или dataset.Dataset
+    :param y: вектор экспериментальных данных, концентраций глюкозы, или одно значение (None, если x - Dataset)
+    :param method: способ решения ДУ (см. find_g)
+    :param chunk_size: максимальное количество наборов параметров в одном вызове, чтобы ограничить память (не обязательно)
+    :return: вектор из P значений функции потерь
+    """
+    parameters = np.atleast_2d(np.asarray(parameters, dtype=float))
+    # Один образец тоже считается векторизованным путем (скалярный путь loss_function не принимает массивы параметров)
+    if not isinstance(x, dataset.Dataset): x, y = np.atleast_2d(np.asarray(x, dtype=float)), np.atleast_1d(np.asarray(y, dtype=float))
+    if chunk_size is None: chunk_size = max(len(parameters), 1)
+    loss = np.empty(len(parameters))
+    for start in range(0, len(parameters), chunk_size):
+        chunk = parameters[start:start + chunk_size]
+        loss[start:start + chunk_size] = loss_function(*chunk.T, x, y, method=method)
+    return loss
+
+# Пакетная функция потерь для градиента по формуле центральной разности (см. SGD.gradient_lf)
+loss_function.batch = batch_loss_function
+
+def to_log_parameters(parameters, temp_ref=REFERENCE_TEMP):
+    """
+    Переход от физических параметров к логарифмическим: для каждой реакции
+    a = ln(k0) - en/(R*temp_ref) (логарифм константы скорости при temp_ref) и b = en/R,
+    так что k(T) = exp(a - b*(1/T - 1/temp_ref)). В таких координатах параметры одного масштаба и слабо связаны
+    :param parameters: k0_1, en1, k0_2, en2 (k0 > 0)
+    :param temp_ref: температура центрирования (None - без центрирования, тогда a = ln(k0))
+    :return: массив a1, b1, a2, b2
+    """
+    k0_1, en1, k0_2, en2 = (np.asarray(p, dtype=float) for p in parameters)
+    c = 0 if temp_ref is None else 1 / temp_ref
+    return np.array([np.log(k0_1) - en1 / R * c, en1 / R, np.log(k0_2) - en2 / R * c, en2 / R])
+
+def to_physical_parameters(log_parameters, temp_ref=REFERENCE_TEMP):
+    """
+    Переход от логарифмических параметров (см. to_log_parameters) к физическим
+    :param log_parameters: a1, b1, a2, b2
+    :param temp_ref: температура центрирования (None - без центрирования)
+    :return: массив k0_1, en1, k0_2, en2
+    """
+    a1, b1, a2, b2 = (np.asarray(p, dtype=float) for p in log_parameters)
+    c = 0 if temp_ref is None else 1 / temp_ref
+    # Переполнение exp дает k0 = inf, константа скорости при этом ограничивается в find_k_array
+    with np.errstate(over="ignore"):
+        return np.array([np.exp(a1 + b1 * c), R * b1, np.exp(a2 + b2 * c), R * b2])
+
+def _log_chain(a1, b1, a2, b2, temp_ref):
+    # Матрица производных физических параметров по логарифмическим (строки - k0_1, en1, k0_2, en2)
+    c = 0 if temp_ref is None else 1 / temp_ref
+    k0_1, _, k0_2, _ = to_physical_parameters((a1, b1, a2, b2), temp_ref)
+    return np.array([[k0_1, k0_1 * c, 0, 0],
+                     [0, R, 0, 0],
+                     [0, 0, k0_2, k0_2 * c],
+                     [0, 0, 0, R]])
+
+def log_loss_function(a1, b1, a2, b2, x, y, temp_ref=REFERENCE_TEMP, method="rk4"):
+    """
+    Функция потерь в логарифмической параметризации (см. to_log_parameters). Подходит для всех оптимизаторов SGD.py,
+    найденные параметры переводятся обратно функцией to_physical_parameters
+    :param a1: логарифм константы скорости реакции глюкозы при temp_ref
+    :param b1: энергия активации для глюкозы, деленная на R
+    :param a2: логарифм константы скорости реакции фруктозы при temp_ref
+    :param b2: энергия активации для фруктозы, деленная на R
+    :param x: матрица входных данных, каждая строчка содержит начальную концентрацию глюкозы, температуру и время, или dataset.Dataset
+    :param y: вектор экспериментальных данных, концентраций глюкозы (None, если x - Dataset)
+    :param temp_ref: температура центрирования (None - без центрирования)
+    :param method: способ решения ДУ (см. find_g)
+    :return: Сумма квадратов разностей расчетной концентрации глюкозы и экспериментальной
+    """
+    return loss_function(*to_physical_parameters((a1, b1, a2, b2), temp_ref), x, y, method=method)
+
+def log_gradient_function(a1, b1, a2, b2, x, y, temp_ref=REFERENCE_TEMP, method="rk4"):
+    """
+    Точный градиент функции потерь в логарифмической параметризации
+    :param a1: логарифм константы скорости реакции глюкозы при temp_ref
+    :param b1: энергия активации для глюкозы, деленная на R
+    :param a2: логарифм константы скорости реакции фруктозы при temp_ref
+    :param b2: энергия активации для фруктозы, деленная на R
+    :param x: матрица входных данных, одна строчка или dataset.Dataset
+    :param y: вектор экспериментальных данных или одно значение (None, если x - Dataset)
+    :param temp_ref: температура центрирования (None - без центрирования)
+    :param method: способ решения ДУ (см. find_g)
+    :return: вектор градиента функции потерь
+    """
+    gradient = gradient_function(*to_physical_parameters((a1, b1, a2, b2), temp_ref), x, y, method=method)
+    return gradient @ _log_chain(a1, b1, a2, b2, temp_ref)
+
+def log_residual_jacobian_function(a1, b1, a2, b2, x, y, temp_ref=REFERENCE_TEMP, method="rk4"):
+    """
+    Вектор невязок и его матрица Якоби в логарифмической параметризации
+    :param a1: логарифм константы скорости реакции глюкозы при temp_ref
+    :param b1: энергия активации для глюкозы, деленная на R
+    :param a2: логарифм константы скорости реакции фруктозы при temp_ref
+    :param b2: энергия активации для фруктозы, деленная на R
+    :param x: матрица входных данных, одна строчка или dataset.Dataset
+    :param y: вектор экспериментальных данных или одно значение (None, если x - Dataset)
+    :param temp_ref: температура центрирования (None - без центрирования)
+    :param method: способ решения ДУ (см. find_g)
+    :return: вектор невязок размера N и матрицу Якоби размера (N, 4)
+    """
+    r, J = residual_jacobian_function(*to_physical_parameters((a1, b1, a2, b2), temp_ref), x, y, method=method)
+    return r, J @ _log_chain(a1, b1, a2, b2, temp_ref)
+
+log_loss_function.gradient = log_gradient_function
+log_loss_function.residual_jacobian = log_residual_jacobian_function
 
 def generate_data(seed):
     """
@@ -129,6 +396,12 @@ def optimize():
     print(f"Функция потерь для оптимизированных параметров: {lost_mbsgd:.3}")
     print(f"Дельта: {lost_mbsgd - real_lost:.3}\n")
 
+    parameters_lm = levenberg_marquardt_lf(loss_function, initial_parameters, 0.001, 100, x, y)
+    lost_lm = loss_function(*parameters_lm, x, y)
+    print(f"\nОптимизированные параметры: k0_1 = {parameters_lm[0]:.3e}, en1 = {parameters_lm[1]:.3e}, k0_2 = {parameters_lm[2]:.3e}, en2 = {parameters_lm[3]:.3e}")
+    print(f"Функция потерь для оптимизированных параметров: {lost_lm:.3}")
+    print(f"Дельта: {lost_lm - real_lost:.3}\n")
+
     # Построение графиков
     t_10 = []
     g_10 = []
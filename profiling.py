@@ -0,0 +1,126 @@
+import time
+from contextlib import contextmanager, nullcontext
+
+# Текущая трассировка, в которую решатели ДУ добавляют количество вызовов и шагов.
+# None - профилирование выключено, тогда решатели только проверяют это значение
+active = None
+# Пустой контекст для этапов, когда профилирование выключено (один объект на все вызовы)
+_null_phase = nullcontext()
+
+
+class Trace:
+    """
+    Трассировка работы оптимизатора: счетчики вызовов, время по этапам и функция потерь по итерациям
+    """
+
+    def __init__(self, name=""):
+        """
+        :param name: название оптимизатора
+        """
+        self.name = name
+        # количество вызовов функции потерь (loss_function), градиента (gradient), find_g (find_g),
+        # шагов метода Рунге-Кутты (rk4_steps) и метода Дормана-Принса (dopri5_steps). Шаги суммируются
+        # по всем интегрируемым траекториям: по образцам или, для "grouped", по группам образцов
+        self.counters = {}
+        # суммарное время по этапам в секундах
+        self.phase_time = {}
+        # номера итераций и значения функции потерь на них
+        self.iterations = []
+        self.loss_history = []
+        self.n_iter = 0
+        self.total_time = 0.0
+
+    def count(self, name, n=1):
+        """
+        Увеличение счетчика
+        :param name: название счетчика
+        :param n: приращение
+        """
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Замер времени этапа, время суммируется по всем входам в этап
+        :param name: название этапа
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phase_time[name] = self.phase_time.get(name, 0.0) + time.perf_counter() - start
+
+    def record_loss(self, iteration, loss):
+        """
+        Сохранение значения функции потерь на итерации
+        :param iteration: номер итерации
+        :param loss: значение функции потерь
+        """
+        self.iterations.append(iteration)
+        self.loss_history.append(float(loss))
+
+    def as_dict(self):
+        """
+        :return: словарь со всеми полями трассировки (например, для сохранения в JSON)
+        """
+        return {"name": self.name, "n_iter": self.n_iter, "total_time": self.total_time, "counters": dict(self.counters),
+                "phase_time": dict(self.phase_time), "iterations": list(self.iterations), "loss_history": list(self.loss_history)}
+
+    def __repr__(self):
+        lines = [f"{self.name}: {self.n_iter} итераций, {self.total_time:.3f} с"]
+        lines += [f"  {name}: {value}" for name, value in self.counters.items()]
+        lines += [f"  время {name}: {value:.3f} с ({value / self.total_time:.0%})" if self.total_time > 0 else f"  время {name}: {value:.3f} с"
+                  for name, value in self.phase_time.items()]
+        return "\n".join(lines)
+
+
+def count(name, n=1):
+    """
+    Увеличение счетчика текущей трассировки (ничего не делает, если профилирование выключено)
+    :param name: название счетчика
+    :param n: приращение
+    """
+    if active is not None: active.count(name, n)
+
+
+def phase(trace, name):
+    """
+    Контекст замера времени этапа
+    :param trace: трассировка или None
+    :param name: название этапа
+    :return: контекст Trace.phase или пустой контекст, если trace равна None
+    """
+    return _null_phase if trace is None else trace.phase(name)
+
+
+def counted(function, trace, name):
+    """
+    Обертка функции, увеличивающая счетчик трассировки при каждом вызове
+    :param function: исходная функция
+    :param trace: трассировка
+    :param name: название счетчика
+    :return: обернутая функция
+    """
+    def wrapper(*args, **kwargs):
+        trace.count(name)
+        return function(*args, **kwargs)
+    return wrapper
+
+
+@contextmanager
+def tracing(trace):
+    """
+    Делает трассировку текущей на время выполнения блока (предыдущая восстанавливается при выходе)
+    :param trace: трассировка или None (тогда ничего не меняется)
+    """
+    global active
+    if trace is None:
+        yield
+        return
+    previous, active = active, trace
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.total_time += time.perf_counter() - start
+        active = previous
@@ -1,9 +1,12 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import optimization_2_param as o2p
 import optimization_4_param as o4p
 import numpy as np
-from SGD import minibatch_stochastic_gradient_descent_lf, gradient_descent_lf
-from functions import find_k
-import math
+from SGD import levenberg_marquardt_lf, OptimizationResult, STOP_MAX_ITER, STOP_SMALL_STEP
+from functions import R, nonfinite_to_inf
+from dataset import Dataset
 
 
 def generate_data(seed, T):
@@ -35,37 +38,138 @@ def generate_data(seed, T):
     return x, y
 
 def loss_function(k0, en, x, y):
-    loss = 0
-    for i in range(len(x)):
-        loss += (math.log(x) - y[i])**2
-    loss /= len(x)
-    return loss
-
-
-
-def two_step_optimization():
-    temperatures = [323.15, 333.15, 343.15]
-    # k1_arr = []
-    # k2_arr = []
-    # for T in temperatures:
-    #     x, y = generate_data(42, T)
-    #     initial_parameters = [0, 0]
-    #     alpha = 0.0001
-    #     n_iter = 10
-    #     batch_size = 15
-    #     n_no_change = 100
-    #     parameters_mbsgd = minibatch_stochastic_gradient_descent_lf(o2p.loss_function, initial_parameters, alpha, n_iter, x, y, batch_size, max_n_iter_no_change=n_no_change)
-    #     k1_arr.append(parameters_mbsgd[0])
-    #     k2_arr.append(parameters_mbsgd[1])
+    """
+    Функция потерь для уравнения Аррениуса в логарифмах: среднее квадратов разностей ln(k0) - en/(R*T) и ln(k)
+    :param k0: предэкспоненциальный множитель
+    :param en: энергия активации
+    :param x: вектор температур
+    :param y: вектор констант скорости при этих температурах
+    :return: значение функции потерь (+inf при k0 <= 0)
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        loss = np.mean((np.log(k0) - en / (R * x) - np.log(y)) ** 2)
+    return nonfinite_to_inf(loss)
 
-    initial_parameters = [15000, 0]
-    alpha = 0.11
-    n_iter = 10000
-    parameters_gd = gradient_descent_lf(loss_function, initial_parameters, alpha, n_iter, temperatures, [0.0310, 0.0587, 0.0820])
+def split_by_temperature(x, y):
+    """
+    Разбиение данных модели с 4 параметрами на наборы для модели с 2 параметрами при каждой температуре
+    :param x: матрица входных данных, каждая строчка содержит g0, temp, time
+    :param y: вектор экспериментальных данных
+    :return: вектор температур и список пар (x, y) для каждой из них, строчки x содержат g0, time
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    temperatures = np.unique(x[:, 1])
+    return temperatures, [(x[x[:, 1] == T][:, [0, 2]], y[x[:, 1] == T]) for T in temperatures]
 
-    print("Мои ", loss_function(*parameters_gd, temperatures, [0.0310, 0.0587, 0.0820]))
-    print("Их ", loss_function(5.91e5, 10733, temperatures, [0.0310, 0.0587, 0.0820]))
+def fit_temperature(x, y, initial_parameters=(0.01, 0.01), n_iter=100, epsilon=1e-08):
+    """
+    Первый этап: подбор k1, k2 при одной температуре методом Левенберга-Марквардта
+    :param x: матрица входных данных, каждая строчка содержит g0, time
+    :param y: вектор экспериментальных данных
+    :param initial_parameters: начальные значения k1, k2
+    :param n_iter: максимальное количество итераций
+    :param epsilon: значение для остановки по малому шагу
+    :return: SGD.OptimizationResult, в info["variance"] - оценки дисперсий k1, k2 (диагональ s^2 (J^T J)^-1)
+    """
+    result = levenberg_marquardt_lf(o2p.loss_function, initial_parameters, 1e-3, n_iter, x, y, epsilon=epsilon, suppress_stdout=True, return_result=True)
+    r, J = o2p.residual_jacobian_function(*result.parameters, x, y)
+    s2 = r @ r / max(len(r) - 2, 1)
+    try:
+        variance = s2 * np.diag(np.linalg.inv(J.T @ J))
+    except np.linalg.LinAlgError:
+        variance = np.full(2, np.inf)
+    result.info["variance"] = variance
+    return result
 
+def fit_temperatures(groups, n_workers=1, **fit_parameters):
+    """
+    Первый этап для всех температур: подборы независимы, поэтому выполняются параллельно
+    :param groups: список пар (x, y) для каждой температуры (см. split_by_temperature)
+    :param n_workers: количество процессов (1 - без пула, None - по числу ядер)
+    :param fit_parameters: параметры fit_temperature
+    :return: список результатов fit_temperature в порядке groups
+    """
+    if n_workers is None: n_workers = os.cpu_count()
+    if n_workers <= 1 or len(groups) <= 1:
+        return [fit_temperature(x, y, **fit_parameters) for x, y in groups]
+    with ProcessPoolExecutor(min(n_workers, len(groups))) as executor:
+        return list(executor.map(partial(fit_temperature, **fit_parameters), *zip(*groups)))
 
+def arrhenius_regression(temperatures, k, variance=None):
+    """
+    Второй этап: взвешенный линейный метод наименьших квадратов для ln(k) = ln(k0) - en/(R*T) (в замкнутой форме)
+    :param temperatures: вектор температур
+    :param k: вектор констант скорости
+    :param variance: дисперсии констант скорости, вес точки 1/var(ln k) = k^2/var(k) (None - одинаковые веса)
+    :return: k0, en
+    """
+    temperatures = np.asarray(temperatures, dtype=float)
+    k = np.asarray(k, dtype=float)
+    if np.any(k <= 0): raise ValueError(f"Для перехода к логарифмам константы скорости должны быть положительными: {k}")
+    if variance is None:
+        weights = np.ones(len(k))
+    else:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            weights = k ** 2 / np.asarray(variance, dtype=float)
+        # Точки с неопределенной дисперсией не учитываются, а если таких большинство - веса одинаковые
+        weights = np.where(np.isfinite(weights) & (weights > 0), weights, 0)
+        if np.count_nonzero(weights) < 2: weights = np.ones(len(k))
+    sqrt_w = np.sqrt(weights)
+    A = np.column_stack((np.ones(len(k)), -1 / (R * temperatures)))
+    (ln_k0, en), *_ = np.linalg.lstsq(A * sqrt_w[:, np.newaxis], np.log(k) * sqrt_w, rcond=None)
+    return np.exp(ln_k0), en
 
-    print(parameters_gd)
\ No newline at end of file
+def two_step_optimization(x=None, y=None, n_workers=1, refine=False, n_iter=20, suppress_stdout=False):
+    """
+    Двухэтапная оценка 4-ех параметров: подбор k1, k2 при каждой температуре (параллельно),
+    затем k0, en каждой реакции по уравнению Аррениуса и, при необходимости, короткое совместное уточнение
+    :param x: матрица входных данных, каждая строчка содержит g0, temp, time (по умолчанию o4p.generate_data(42)), или dataset.Dataset
+    :param y: вектор экспериментальных данных (None, если x - Dataset)
+    :param n_workers: количество процессов для первого этапа (1 - без пула, None - по числу ядер)
+    :param refine: уточнить 4 параметра методом Левенберга-Марквардта по всем данным (в логарифмических координатах)
+    :param n_iter: количество итераций уточнения
+    :param suppress_stdout: не выводить сообщения
+    :return: SGD.OptimizationResult с параметрами k0_1, en1, k0_2, en2; в info - температуры (temperatures), k1, k2 и
+    их дисперсии (k1_variance, k2_variance), результаты первого этапа (stage_one), параметры после второго этапа
+    (arrhenius_parameters) и результат уточнения (refinement)
+    """
+    if x is None: x, y = o4p.generate_data(42)
+    if isinstance(x, Dataset): x, y = x.x, x.y
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    temperatures, groups = split_by_temperature(x, y)
+    if len(temperatures) < 2: raise ValueError("Для уравнения Аррениуса нужны данные хотя бы при двух температурах")
+    stage_one = fit_temperatures(groups, n_workers)
+    (k1, k2), (k1_variance, k2_variance) = np.array([r.parameters for r in stage_one]).T, np.array([r.info["variance"] for r in stage_one]).T
+    k0_1, en1 = arrhenius_regression(temperatures, k1, k1_variance)
+    k0_2, en2 = arrhenius_regression(temperatures, k2, k2_variance)
+    parameters = np.array([k0_1, en1, k0_2, en2])
+    info = dict(temperatures=temperatures, k1=k1, k2=k2, k1_variance=k1_variance, k2_variance=k2_variance, stage_one=stage_one,
+                arrhenius_parameters=parameters.copy(), refinement=None)
+    n_done = sum(r.n_iter for r in stage_one)
+    n_loss = sum(r.n_loss for r in stage_one)
+    n_gradient = sum(r.n_gradient for r in stage_one)
+    stop_reason = STOP_MAX_ITER if any(r.stop_reason == STOP_MAX_ITER for r in stage_one) else STOP_SMALL_STEP
+    if not suppress_stdout:
+        for T, r in zip(temperatures, stage_one):
+            print(f"T = {T}: k1 = {r.parameters[0]:.4e}, k2 = {r.parameters[1]:.4e}, функция потерь: {r.loss:.4}")
+        print(f"По уравнению Аррениуса: k0_1 = {k0_1:.3e}, en1 = {en1:.4e}, k0_2 = {k0_2:.3e}, en2 = {en2:.4e}")
+    if refine:
+        refinement = levenberg_marquardt_lf(o4p.log_loss_function, o4p.to_log_parameters(parameters), 1e-3, n_iter, x, y, suppress_stdout=suppress_stdout, return_result=True)
+        parameters = o4p.to_physical_parameters(refinement.parameters)
+        loss = refinement.loss
+        info["refinement"] = refinement
+        n_done += refinement.n_iter
+        n_loss += refinement.n_loss
+        n_gradient += refinement.n_gradient
+        stop_reason = refinement.stop_reason
+    else:
+        loss = o4p.loss_function(*parameters, x, y)
+        n_loss += 1
+    if not suppress_stdout:
+        print(f"Параметры: k0_1 = {parameters[0]:.3e}, en1 = {parameters[1]:.4e}, k0_2 = {parameters[2]:.3e}, en2 = {parameters[3]:.4e}")
+        print(f"Функция потерь: {loss:.4}")
+    return OptimizationResult("two_step_optimization", parameters, loss, n_done, stop_reason, n_loss, n_gradient, info=info)
@@ -1,50 +1,74 @@
 import matplotlib.pyplot as plt
 import numpy as np
-import two_step_optimization as tso
-from functions import find_k
-from optimization_2_param import generate_data, loss_function
+from functions import find_k, find_k_array
+from optimization_2_param import generate_data, batch_loss_function
+from loss_surface import loss_surface
 
 
 def vis_loss_function(k0, en, x, y):
     return (find_k(k0, en, x) - y)**2
 
-def visualize_k_loss(temp: float, k_real: float, range_k0: list, range_en: list, num_of_points: int):
+def k_batch_loss_function(parameters, x, y):
+    """
+    Квадрат разности константы скорости и эталонной сразу для набора k0, en (для loss_surface)
+    :param parameters: матрица параметров размера (P, 2), каждая строчка содержит k0, en
+    :param x: температура
+    :param y: эталонная константа скорости
+    :return: вектор из P значений функции потерь
+    """
+    parameters = np.atleast_2d(np.asarray(parameters, dtype=float))
+    return (find_k_array(parameters[:, 0], parameters[:, 1], x) - y)**2
+
+def plot_surface(axis_1, axis_2, loss, labels=("", "", "loss"), cmap="viridis", elev=None, azim=None):
+    """
+    Построение 3d графика по готовой поверхности (см. loss_surface.loss_surface)
+    :param axis_1: ось первого параметра
+    :param axis_2: ось второго параметра
+    :param loss: матрица потерь размера (len(axis_2), len(axis_1))
+    :param labels: подписи осей
+    :param cmap: цветовая схема
+    :param elev: угол обзора по вертикали (не обязательно)
+    :param azim: угол обзора по горизонтали (не обязательно)
+    """
+    grid_1, grid_2 = np.meshgrid(axis_1, axis_2)
+    fig, ax = plt.subplots(subplot_kw={"projection": "3d"})
+    # Точки с переполнением не рисуются
+    ax.plot_surface(grid_1, grid_2, np.ma.masked_invalid(loss), cmap=cmap)
+    ax.set_xlabel(labels[0])
+    ax.set_ylabel(labels[1])
+    ax.set_zlabel(labels[2])
+    if elev is not None or azim is not None: ax.view_init(elev=elev, azim=azim)
+    plt.show()
+
+def visualize_k_loss(temp: float, k_real: float, range_k0: list, range_en: list, num_of_points: int, refine_levels=0, n_workers=1, cmap="viridis"):
     """
     Визуализация функции потерь
     :param temp: Температура
+    :param k_real: эталонная константа скорости
     :param range_k0: границы k0
     :param range_en: границы en
     :param num_of_points: количество точек
+    :param refine_levels: количество уровней уточнения около минимума (см. loss_surface.loss_surface)
+    :param n_workers: количество процессов для расчета поверхности
+    :param cmap: цветовая схема
     """
-    # Подготовка данных
-    R = 1.987
-    k0 = np.linspace(range_k0[0], range_k0[1], num_of_points)
-    en = np.linspace(range_en[0], range_en[1], num_of_points)
-    k0, en = np.meshgrid(k0, en)
-    tso.generate_data(42, temp)
-    k = (k0*np.exp(-en/(R * temp)) - k_real)**2
-    # Построение графика
-    fig, ax = plt.subplots(subplot_kw={"projection": "3d"})
-    ax.plot_surface(k0, en, k, cmap="viridis")
-    ax.set_xlabel('k0')
-    ax.set_ylabel('en')
-    ax.set_zlabel('loss')
-    plt.show()
+    # Поверхность считается один раз и читается с диска при повторном построении
+    k0, en, k = loss_surface(k_batch_loss_function, temp, k_real, range_k0, range_en, num_of_points, refine_levels=refine_levels, n_workers=n_workers)
+    plot_surface(k0, en, k, labels=("k0", "en", "loss"), cmap=cmap)
 
 
-def visualize_loss_function(range_k1: list, range_k2: list, num_of_points: int, ):
-    # Подготовка данных
-    k1_arr = np.linspace(range_k1[0], range_k1[1], num_of_points)
-    k2_arr = np.linspace(range_k2[0], range_k2[1], num_of_points)
-    k1_arr, k2_arr = np.meshgrid(k1_arr, k2_arr)
+def visualize_loss_function(range_k1: list, range_k2: list, num_of_points: int, refine_levels=0, n_workers=1, cmap="viridis", elev=30, azim=90):
+    """
+    Визуализация функции потерь модели с 2 параметрами
+    :param range_k1: границы k1
+    :param range_k2: границы k2
+    :param num_of_points: количество точек
+    :param refine_levels: количество уровней уточнения около минимума (см. loss_surface.loss_surface)
+    :param n_workers: количество процессов для расчета поверхности
+    :param cmap: цветовая схема
+    :param elev: угол обзора по вертикали
+    :param azim: угол обзора по горизонтали
+    """
     x, y = generate_data(42)
-    loss_arr = loss_function(k1_arr, k2_arr, x, y)
-
-    # Построение 3d графика
-    fig = plt.figure()
-    ax = fig.add_subplot(111, projection = '3d')
-
-    ax.plot_surface(k1_arr, k2_arr, loss_arr, cmap = 'viridis')
-
-    ax.view_init(elev=30, azim=90)
-    plt.show()
\ No newline at end of file
+    k1_arr, k2_arr, loss_arr = loss_surface(batch_loss_function, x, y, range_k1, range_k2, num_of_points, refine_levels=refine_levels, n_workers=n_workers)
+    plot_surface(k1_arr, k2_arr, loss_arr, labels=("k1", "k2", "loss"), cmap=cmap, elev=elev, azim=azim)